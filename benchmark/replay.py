@@ -0,0 +1,288 @@
+"""离线压测：使用本地模拟直播平台服务器端到端运行录制程序
+
+模拟服务器实现各平台直播检测用到的接口（哔哩哔哩、Twitch、斗鱼、抖音、Bigolive），
+并按指定码率生成模拟的FLV和HLS直播流，部分直播间会在压测期间随机开播
+
+用法：
+    python benchmark/replay.py --rooms 100 500 1000 --duration 60
+
+输出检测请求吞吐量、事件循环阻塞、每个直播间的内存占用、录制写入速率和开播到首次写入的延迟
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+from loguru import logger
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import live_recorder  # noqa: E402
+
+# 支持录制的平台直播流由模拟服务器直接提供，其余平台仅模拟检测接口
+RECORDABLE = ('Douyu', 'Douyin', 'Bigolive')
+PLATFORMS = ('Bilibili', 'Twitch') + RECORDABLE
+
+
+def flv_tag(tag_type: int, data: bytes, timestamp: int) -> bytes:
+    return (bytes([tag_type]) + len(data).to_bytes(3, 'big') + (timestamp & 0xffffff).to_bytes(3, 'big') +
+            bytes([timestamp >> 24 & 0xff]) + b'\0\0\0' + data + (11 + len(data)).to_bytes(4, 'big'))
+
+
+class MockPlatform:
+    """模拟各直播平台接口和直播流的HTTP服务器
+
+    运行在独立线程的事件循环中，避免与录制程序互相阻塞，也不计入录制程序的事件循环阻塞
+    """
+
+    def __init__(self, bitrate: float):
+        self.bitrate = bitrate
+        self.live: dict = {}
+        self.requests = 0
+        self.port = 0
+        self.loop = asyncio.new_event_loop()
+
+    def start(self):
+        ready = threading.Event()
+
+        def serve():
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, '127.0.0.1', 0))
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def go_live(self, room: str):
+        self.live[room] = time.monotonic()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if not await self.route(method, target, body, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def respond(writer, body, content_type='application/json', headers=''):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'{headers}\r\n'.encode() + body)
+
+    async def route(self, method, target, body, writer) -> bool:
+        """处理一个请求，返回False时关闭连接"""
+        url = urlsplit(target)
+        path, query = url.path, parse_qs(url.query)
+        base = f'http://127.0.0.1:{self.port}'
+        if path.startswith('/stream/'):
+            await self.stream_flv(path.split('/')[-1].split('.')[0], writer)
+            return False
+        if path.startswith('/hls/'):
+            self.hls(path, writer)
+            await writer.drain()
+            return True
+        self.requests += 1
+        if path.endswith('/getRoomBaseInfo'):
+            self.respond(writer, {'data': {'by_room_ids': {
+                room: {'live_status': 0, 'title': ''} for room in query['room_ids']}}})
+        elif path.endswith('/gql'):
+            self.respond(writer, [{'data': {'user': {'stream': None, 'lastBroadcast': {'title': ''}}}}
+                                  for _ in json.loads(body)])
+        elif '/api/RoomApi/room/' in path:
+            room = path.split('/')[-1]
+            self.respond(writer, {'data': {'room_status': '1' if room in self.live else '2',
+                                           'start_time': '', 'room_name': f'斗鱼{room}'}})
+        elif path.endswith('/swf_api/homeH5Enc'):
+            room = query['rids'][0]
+            self.respond(writer, {'data': {
+                f'room{room}': 'function ub98484234(rid, did, tt) { return "v=" + CryptoJS.v + "&sign=" + tt; }'}})
+        elif path.endswith('/crypto.js'):
+            self.respond(writer, b'var CryptoJS = {v: "220120"};', 'application/javascript', 'ETag: "mock"\r\n')
+        elif '/lapi/live/getH5Play/' in path:
+            room = path.split('/')[-1]
+            self.respond(writer, {'error': 0, 'msg': '', 'data': {
+                'rtmp_url': f'{base}/stream', 'rtmp_live': f'{room}.flv'}})
+        elif path == '/live.douyin.com/':
+            self.respond(writer, b'', 'text/html', 'Set-Cookie: ttwid=mock; Path=/\r\n')
+        elif path.endswith('/webcast/room/web/enter/'):
+            room = query['web_rid'][0]
+            stream_data = json.dumps({'data': {'origin': {'main': {'flv': f'{base}/stream/{room}.flv'}}}})
+            self.respond(writer, {'data': {'data': [{
+                'status': 2 if room in self.live else 4,
+                'title': f'抖音{room}',
+                'stream_url': {'live_core_sdk_data': {'pull_data': {'stream_data': stream_data}}}
+            }]}})
+        elif path.endswith('/getInternalStudioInfo'):
+            room = query['siteId'][0]
+            self.respond(writer, {'data': {'alive': room in self.live, 'roomTopic': f'Bigo{room}',
+                                           'hls_src': f'{base}/hls/{room}.m3u8'}})
+        else:
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+        await writer.drain()
+        return True
+
+    async def stream_flv(self, room: str, writer: asyncio.StreamWriter):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: video/x-flv\r\nConnection: close\r\n\r\n')
+        writer.write(b'FLV\x01\x05\0\0\0\x09\0\0\0\0' + flv_tag(18, b'\x02\0\x0aonMetaData', 0) +
+                     flv_tag(9, b'\x17\0\0\0\0' + b'\x01' * 32, 0) + flv_tag(8, b'\xaf\0\x12\x10', 0))
+        # 每40ms发送一帧，每2秒一个关键帧
+        frame_size = int(self.bitrate / 8 * 0.04)
+        frame = 0
+        start = time.monotonic()
+        while True:
+            keyframe = frame % 50 == 0
+            writer.write(flv_tag(9, (b'\x17\x01' if keyframe else b'\x27\x01') + b'\0\0\0' + bytes(frame_size),
+                                 frame * 40))
+            await writer.drain()
+            frame += 1
+            await asyncio.sleep(max(0.0, start + frame * 0.04 - time.monotonic()))
+
+    def hls(self, path: str, writer):
+        room = path.split('/')[2].split('.')[0]
+        sequence = int((time.monotonic() - self.live.get(room, time.monotonic())) / 2)
+        if path.endswith('.m3u8'):
+            segments = ''.join(f'#EXTINF:2.0,\n/hls/{room}/{n}.ts\n' for n in range(max(0, sequence - 2), sequence + 1))
+            self.respond(writer, f'#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:2\n'
+                                 f'#EXT-X-MEDIA-SEQUENCE:{max(0, sequence - 2)}\n{segments}'.encode(),
+                         'application/vnd.apple.mpegurl')
+        else:
+            packet = b'\x47\x41\x00\x10' + bytes(184)
+            self.respond(writer, packet * int(self.bitrate / 8 * 2 / 188), 'video/mp2t')
+
+
+class RewriteTransport(httpx.AsyncHTTPTransport):
+    """将发往各直播平台的请求改写到模拟服务器，原主机名作为路径前缀"""
+
+    def __init__(self, port: int, **kwargs):
+        super().__init__(**kwargs)
+        self.port = port
+
+    async def handle_async_request(self, request: httpx.Request):
+        if request.url.host != '127.0.0.1':
+            request.url = httpx.URL(f'http://127.0.0.1:{self.port}/{request.url.host}{request.url.raw_path.decode()}')
+        return await super().handle_async_request(request)
+
+
+def rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+async def replay(rooms: int, duration: float, interval: float, live_ratio: float, bitrate: float):
+    mock = MockPlatform(bitrate * 1e6)
+    mock.start()
+    live_recorder.LiveRecoder.get_client = lambda self: httpx.AsyncClient(
+        transport=RewriteTransport(mock.port, limits=httpx.Limits(max_connections=100)))
+    # 记录每个直播间首次写入录制文件的时间和写入总量
+    first_write = {}
+    written = [0]
+    write = live_recorder.BufferedFileOutput._write
+
+    def timed_write(output, data):
+        first_write.setdefault(output.filename.parent.name, time.monotonic())
+        written[0] += len(data)
+        return write(output, data)
+
+    live_recorder.BufferedFileOutput._write = timed_write
+
+    users = [{
+        'platform': PLATFORMS[index % len(PLATFORMS)],
+        'id': str(100000 + index),
+        'interval': interval,
+        'crypto_js_url': 'https://cdn.mock/crypto.js',
+        'output': f'output/{PLATFORMS[index % len(PLATFORMS)]}_{100000 + index}'
+    } for index in range(rooms)]
+    Path('config.json').write_text(json.dumps({'progress': False, 'user': users}), encoding='utf-8')
+    recordable = [user for user in users if user['platform'] in RECORDABLE]
+    going_live = random.sample(recordable, min(len(recordable), max(1, int(rooms * live_ratio))))
+
+    baseline = rss()
+    task = asyncio.create_task(live_recorder.run())
+    start = time.monotonic()
+    await asyncio.sleep(interval * 2)
+    idle_memory = (rss() - baseline) / rooms
+    requests_before, measure_start = mock.requests, time.monotonic()
+    for user in going_live:
+        asyncio.get_running_loop().call_later(
+            random.uniform(0, max(0.0, duration / 2 - interval * 2)), mock.go_live, user['id'])
+    await asyncio.sleep(max(0.0, duration - (time.monotonic() - start)))
+    elapsed = time.monotonic() - measure_start
+    poll_rate = (mock.requests - requests_before) / elapsed
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    mock.stop()
+
+    latencies = [first_write[f'{user["platform"]}_{user["id"]}'] - mock.live[user['id']]
+                 for user in going_live if f'{user["platform"]}_{user["id"]}' in first_write]
+    print(f'直播间{rooms}个，压测{duration:.0f}s，检测间隔{interval}s')
+    print(f'  检测请求吞吐量：{poll_rate:.1f}次/s')
+    print(f'  事件循环阻塞：最大{live_recorder.loop_monitor.blocked_max * 1000:.1f}ms，'
+          f'累计{live_recorder.loop_monitor.blocked:.2f}s')
+    print(f'  每个直播间内存占用（开播前）：{idle_memory / 1024:.1f}KB')
+    print(f'  录制{len(latencies)}/{len(going_live)}个直播，写入{written[0] / 1024 / 1024:.1f}MB，'
+          f'平均写入速率{written[0] / 1024 / 1024 / elapsed:.2f}MB/s')
+    if latencies:
+        print(f'  开播到首次写入延迟：平均{statistics.mean(latencies):.2f}s，'
+              f'中位{statistics.median(latencies):.2f}s，最大{max(latencies):.2f}s')
+
+
+def run_round(rooms, duration, interval, live_ratio, bitrate):
+    # 子进程以spawn方式启动时不会继承主进程的日志配置
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    asyncio.run(replay(rooms, duration, interval, live_ratio, bitrate))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, nargs='+', default=[100])
+    parser.add_argument('--duration', type=float, default=60, help='每轮压测时长（秒）')
+    parser.add_argument('--interval', type=float, default=10, help='直播间检测间隔（秒）')
+    parser.add_argument('--live-ratio', type=float, default=0.05, help='压测期间开播的直播间比例')
+    parser.add_argument('--bitrate', type=float, default=2, help='模拟直播流码率（Mbps）')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='live_recorder_replay_'))
+    for rooms in args.rooms:
+        # 每轮压测在独立进程中运行，内存占用互不影响
+        process = multiprocessing.Process(target=run_round, args=(
+            rooms, args.duration, args.interval, args.live_ratio, args.bitrate))
+        process.start()
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""未开播直播间的内存占用
+
+按配置添加指定数量的直播间，统计调度器和直播间状态占用的内存，并与为每个直播间常驻录制对象的占用对比
+
+用法：
+    python benchmark/room_memory.py --rooms 1000 5000
+"""
+import argparse
+import asyncio
+import sys
+import tracemalloc
+from pathlib import Path
+
+from loguru import logger
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import live_recorder  # noqa: E402
+
+PLATFORMS = ('Bilibili', 'Douyu', 'Huya', 'Douyin', 'Twitch', 'Youtube')
+
+
+def traced(func):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = func()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return size, result
+
+
+async def measure(rooms: int):
+    config = {'user': [{'platform': PLATFORMS[index % len(PLATFORMS)], 'id': str(100000 + index)}
+                       for index in range(rooms)]}
+    manager = live_recorder.Manager(config, live_recorder.Scheduler(config))
+    room_size, _ = traced(lambda: manager.reconcile(config))
+    recorder_size, _ = traced(lambda: [room.create() for room in manager.rooms.values()])
+    print(f'直播间{rooms}个：直播间状态和调度队列{room_size / rooms:.0f}B/个，'
+          f'常驻录制对象还需{recorder_size / rooms:.0f}B/个')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1000, 5000])
+    args = parser.parse_args()
+
+    logger.remove()
+    for rooms in args.rooms:
+        asyncio.run(measure(rooms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""网页检测直播状态的流式读取性能对比
+
+使用模拟的直播间页面，对比原实现（每次下载完整页面并解码后查找）与当前实现（流式读取，读到直播状态后停止下载，
+未开播时使用条件请求）每次检测传输的数据量和CPU耗时
+
+用法：
+    python benchmark/scrape.py [--size 500] [--repeat 200]
+"""
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+import httpx
+from loguru import logger
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import live_recorder  # noqa: E402
+
+CHUNK_SIZE = 16384
+
+
+async def legacy_huya(recorder):
+    response = (await recorder.request(method='GET', url=f'https://www.huya.com/{recorder.id}')).text
+    if '"isOn":true' in response:
+        return re.search('"introduction":"(.*?)"', response).group(1)
+
+
+async def legacy_niconico(recorder):
+    response = (await recorder.request(method='GET', url=f'https://live.nicovideo.jp/watch/{recorder.id}')).text
+    if '"content_status":"ON_AIR"' in response:
+        return json.loads(re.search(r'<script type="application/ld\+json">(.*?)</script>', response).group(1))['name']
+
+
+async def legacy_twitcasting(recorder):
+    response = (await recorder.request(method='GET', url='https://twitcasting.tv/streamserver.php',
+                                       params={'target': recorder.id, 'mode': 'client'})).json()
+    if response:
+        response = (await recorder.request(method='GET', url=f'https://twitcasting.tv/{recorder.id}')).text
+        return re.search('<meta name="twitter:title" content="(.*?)">', response).group(1)
+
+
+async def legacy_pixivsketch(recorder):
+    response = (await recorder.request(method='GET', url=f'https://sketch.pixiv.net/{recorder.id}')).text
+    next_data = json.loads(re.search(r'<script id="__NEXT_DATA__".*?>(.*?)</script>', response)[1])
+    initial_state = json.loads(next_data['props']['pageProps']['initialState'])
+    if lives := initial_state['live']['lives']:
+        return list(lives.values())[0]['name']
+
+
+LEGACY = {
+    'Huya': legacy_huya,
+    'Niconico': legacy_niconico,
+    'Twitcasting': legacy_twitcasting,
+    'Pixivsketch': legacy_pixivsketch,
+}
+
+
+def filler(size: int) -> str:
+    line = '<div class="item"><a href="/room/123456" title="推荐直播间">推荐直播间</a><img src="/cover.jpg"></div>\n'
+    return line * (size // len(line.encode()) + 1)
+
+
+def make_page(platform: str, live: bool, size: int) -> bytes:
+    """按各平台页面结构生成模拟页面，直播状态和标题所在位置与实际页面大致相同"""
+    title = '模拟直播标题'
+    if platform == 'Huya':
+        data = json.dumps({'isOn': live, 'introduction': title}, ensure_ascii=False, separators=(',', ':'))
+        page = f'<html><head>{filler(size // 4)}</head><body>{filler(size // 10)}' \
+               f'<script>var TT_ROOM_DATA = {data};</script>{filler(size * 6 // 10)}</body></html>'
+    elif platform == 'Niconico':
+        status = 'ON_AIR' if live else 'ENDED'
+        ld_json = json.dumps({'@type': 'VideoObject', 'name': title}, ensure_ascii=False)
+        page = f'<html><head><script type="application/ld+json">{ld_json}</script>{filler(size // 3)}</head>' \
+               f'<body><script>var data = {{"content_status":"{status}"}};</script>{filler(size * 2 // 3)}</body></html>'
+    elif platform == 'Twitcasting':
+        page = f'<html><head><meta name="twitter:title" content="{title}">{filler(size // 5)}</head>' \
+               f'<body>{filler(size * 4 // 5)}</body></html>'
+    else:
+        lives = {'1': {'name': title, 'owner': {'hls_movie': 'https://mock/live.m3u8'}}} if live else {}
+        state = json.dumps({'live': {'lives': lives}, 'users': {str(i): {'name': f'用户{i}'} for i in range(300)}})
+        data = json.dumps({'props': {'pageProps': {'initialState': state}}}, separators=(',', ':'))
+        page = f'<html><head>{filler(size // 10)}</head><body>{filler(size * 7 // 10)}' \
+               f'<script id="__NEXT_DATA__" type="application/json">{data}</script>{filler(size // 10)}</body></html>'
+    return page.encode()
+
+
+class CountingStream(httpx.AsyncByteStream):
+    """分块返回响应内容并统计实际被读取的字节数，提前关闭时不再继续发送"""
+
+    def __init__(self, content: bytes, counter: list):
+        self.content = content
+        self.counter = counter
+
+    async def __aiter__(self):
+        for start in range(0, len(self.content), CHUNK_SIZE):
+            chunk = self.content[start:start + CHUNK_SIZE]
+            self.counter[0] += len(chunk)
+            yield chunk
+
+
+def make_client(platform: str, live: bool, size: int, etag: bool, counter: list):
+    page = make_page(platform, live, size)
+
+    def handler(request: httpx.Request):
+        if request.url.path == '/streamserver.php':
+            content = json.dumps({'movie': {'live': True}} if live else {}).encode()
+            counter[0] += len(content)
+            return httpx.Response(200, content=content)
+        headers = {'ETag': '"v1"'} if etag else {}
+        if etag and request.headers.get('If-None-Match') == '"v1"':
+            return httpx.Response(304, headers=headers)
+        return httpx.Response(200, headers=headers, stream=CountingStream(page, counter))
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def measure(platform: str, live: bool, etag: bool, size: int, repeat: int, legacy: bool):
+    counter = [0]
+    room = live_recorder.Room({}, {'platform': platform, 'id': '123456'})
+    recorder = room.create()
+    live_recorder.clients[recorder.client_key] = make_client(platform, live, size, etag, counter)
+    titles = []
+
+    async def record(stream, url, title, format):
+        titles.append(title)
+
+    async def get_streams(url, options=None):
+        return {'best': None}
+
+    async def resolve(func):
+        return {'best': None}
+
+    recorder.record, recorder.get_streams, recorder.resolve = record, get_streams, resolve
+    start = time.process_time()
+    for _ in range(repeat):
+        if legacy:
+            if title := await LEGACY[platform](recorder):
+                titles.append(title)
+        else:
+            await recorder.run()
+    cpu = (time.process_time() - start) / repeat
+    await live_recorder.clients.pop(recorder.client_key).aclose()
+    return counter[0] / repeat, cpu, titles[:1]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=500, help='模拟页面大小（KB）')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    logger.remove()
+    scenarios = (('未开播', False, False), ('未开播且页面未变化（支持ETag）', False, True), ('直播中', True, False))
+    for platform in LEGACY:
+        for name, live, etag in scenarios:
+            if platform == 'Twitcasting' and not live:
+                # 未开播时只请求状态接口，与原实现相同
+                continue
+            legacy_bytes, legacy_cpu, legacy_title = await measure(platform, live, etag, args.size * 1024, args.repeat, True)
+            current_bytes, current_cpu, current_title = await measure(platform, live, etag, args.size * 1024, args.repeat, False)
+            assert legacy_title == current_title, f'{platform}{name}：解析结果不一致'
+            print(f'{platform}{name}：每次检测传输{legacy_bytes / 1024:.0f}KB -> {current_bytes / 1024:.0f}KB，'
+                  f'CPU耗时{legacy_cpu * 1000:.2f}ms -> {current_cpu * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
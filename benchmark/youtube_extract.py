@@ -0,0 +1,83 @@
+"""YouTube直播检测解析性能对比
+
+对比原实现（每次编译JSONPath、完整遍历并序列化每个视频）与当前实现的耗时
+
+用法：
+    python benchmark/youtube_extract.py [browse响应文件.json ...]
+
+未指定文件时使用生成的模拟数据，录制真实响应可保存YouTube频道直播页browse接口的响应内容
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from jsonpath_ng.ext import parse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from live_recorder import Youtube  # noqa: E402
+
+
+def legacy(content: bytes):
+    response = json.loads(content)
+    return [
+        match.value for match in parse('$..videoWithContextRenderer').find(response)
+        if '"style": "LIVE"' in json.dumps(match.value)
+    ]
+
+
+def make_payload(count: int, live: bool) -> bytes:
+    def video(index):
+        return {'richItemRenderer': {'content': {'videoWithContextRenderer': {
+            'videoId': f'video{index:06d}',
+            'headline': {'runs': [{'text': f'直播标题{index}' * 5}]},
+            'thumbnail': {'thumbnails': [{'url': f'https://i.ytimg.com/vi/{index}/{size}.jpg', 'width': size}
+                                         for size in (120, 320, 480, 640)]},
+            'thumbnailOverlays': [{'thumbnailOverlayTimeStatusRenderer': {
+                'text': {'runs': [{'text': '直播' if live and index == 0 else '1:23:45'}]},
+                'style': 'LIVE' if live and index == 0 else 'DEFAULT'
+            }}],
+            'navigationEndpoint': {'commandMetadata': {'webCommandMetadata': {'url': f'/watch?v={index}'}},
+                                   'watchEndpoint': {'videoId': f'video{index:06d}', 'params': 'x' * 200}},
+            'trackingParams': 'x' * 300
+        }}}}
+
+    return json.dumps({'contents': {'singleColumnBrowseResultsRenderer': {'tabs': [
+        {'tabRenderer': {'content': {'richGridRenderer': {'contents': [video(i) for i in range(count)]}}}}
+    ]}}}, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def measure(func, content: bytes, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(content)
+    return (time.perf_counter() - start) / repeat, [video['videoId'] for video in result]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', type=Path)
+    parser.add_argument('--count', type=int, default=300, help='模拟数据的视频数量')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.files:
+        payloads = {file.name: file.read_bytes() for file in args.files}
+    else:
+        payloads = {
+            f'模拟未开播（{args.count}个视频）': make_payload(args.count, False),
+            f'模拟直播中（{args.count}个视频）': make_payload(args.count, True),
+        }
+    for name, content in payloads.items():
+        legacy_time, legacy_result = measure(legacy, content, args.repeat)
+        current_time, current_result = measure(Youtube.get_live_videos, content, args.repeat)
+        assert legacy_result == current_result, f'{name}：解析结果不一致'
+        print(f'{name}，{len(content) / 1024:.0f}KB，直播中{len(current_result)}个：'
+              f'原实现{legacy_time * 1000:.2f}ms，当前实现{current_time * 1000:.2f}ms，'
+              f'提升{legacy_time / current_time:.1f}倍')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,25 @@
 import asyncio
+import bisect
+import contextvars
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
+import random
 import re
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from http.cookies import SimpleCookie
 from pathlib import Path
-from typing import Dict, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 from urllib.parse import parse_qs
 
 import anyio
@@ -17,22 +30,1192 @@ import streamlink
 from httpx_socks import AsyncProxyTransport
 from jsonpath_ng.ext import parse
 from loguru import logger
+from streamlink.exceptions import StreamError
 from streamlink.options import Options
 from streamlink.stream import StreamIO, HTTPStream, HLSStream
-from streamlink_cli.main import open_stream
-from streamlink_cli.output import FileOutput
+from streamlink.stream.hls import HLSStreamReader, HLSStreamWorker, HLSStreamWriter
+from streamlink_cli.output import FileOutput, Output
 from streamlink_cli.streamrunner import StreamRunner
 
 recording: Dict[str, Tuple[StreamIO, FileOutput]] = {}
+# 程序退出时设置，正在录制的直播不再重新连接
+stopping = threading.Event()
+# 直播流解析使用的线程池，阻塞的streamlink插件解析不占用事件循环
+resolver = ThreadPoolExecutor(max_workers=8, thread_name_prefix='resolver')
+# 创建录制文件使用的线程池，与打开直播流同时进行
+file_opener = ThreadPoolExecutor(max_workers=4, thread_name_prefix='opener')
+# 进程内复用的streamlink会话，以及按直播间网址缓存的直播流解析结果，值为(解析时间, 插件选项, 解析结果)
+sessions: Dict[str, streamlink.session.Streamlink] = {}
+sessions_lock = threading.Lock()
+stream_cache: Dict[str, Tuple[float, tuple, dict]] = {}
+# 全局共享的HTTP连接池，以(代理, SSL验证, 平台)为键
+clients: Dict[Tuple[str, bool, str], httpx.AsyncClient] = {}
 
 
-class LiveRecoder:
+class StatusBatcher:
+    """将同一平台在短时间窗口内的直播状态查询合并为一次批量请求"""
+
+    def __init__(self, size: int, window: float):
+        self.size = size
+        self.window = window
+        self.pending: Dict[str, Tuple['LiveRecoder', asyncio.Future]] = {}
+        self.timer = None
+
+    async def get(self, recorder: 'LiveRecoder'):
+        # 配置中的id可能为数字，批量接口返回的结果以字符串为键
+        room_id = str(recorder.id)
+        if room_id not in self.pending:
+            self.pending[room_id] = (recorder, asyncio.get_running_loop().create_future())
+        future = self.pending[room_id][1]
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        if pending:
+            asyncio.create_task(self.fetch(pending))
+
+    async def fetch(self, pending: Dict[str, Tuple['LiveRecoder', asyncio.Future]]):
+        # 使用最先加入批次的直播间发起请求，同批次直播间的代理、请求头和cookie均一致
+        recorder = next(iter(pending.values()))[0]
+        try:
+            # 批量请求不属于单个直播间，清除触发请求的直播间的日志字段
+            with logger.contextualize(room='', platform=recorder.platform):
+                result = await recorder.get_status_batch(list(pending))
+        except Exception as error:
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for room_id, (_, future) in pending.items():
+                if not future.done():
+                    future.set_result(result.get(room_id))
+
+
+# 以(代理, SSL验证, 平台, 请求头和cookie)为键
+batchers: Dict[Tuple[str, bool, str, str], StatusBatcher] = {}
+
+
+class JSCache:
+    """签名所需JS脚本的内存和磁盘缓存，以及预加载脚本的JS引擎池"""
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = Path(path)
+        self.size = size
+        self.scripts: Dict[str, dict] = {}
+        self.engines: Dict[str, list] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def load(self, url: str):
+        if url not in self.scripts:
+            file = self.path / hashlib.sha1(url.encode()).hexdigest()
+            if file.with_suffix('.json').exists() and file.with_suffix('.js').exists():
+                script = json.loads(file.with_suffix('.json').read_text(encoding='utf-8'))
+                script['source'] = file.with_suffix('.js').read_text(encoding='utf-8')
+                self.scripts[url] = script
+        return self.scripts.get(url)
+
+    def save(self, url: str, script: dict):
+        if self.scripts.get(url, {}).get('source') != script['source']:
+            # 脚本内容变化时丢弃已预加载旧脚本的引擎
+            self.engines.pop(url, None)
+        self.scripts[url] = script
+        file = self.path / hashlib.sha1(url.encode()).hexdigest()
+        self.path.mkdir(parents=True, exist_ok=True)
+        file.with_suffix('.js').write_text(script['source'], encoding='utf-8')
+        file.with_suffix('.json').write_text(
+            json.dumps({k: v for k, v in script.items() if k != 'source'}), encoding='utf-8')
+
+    async def get(self, recorder: 'LiveRecoder', url: str, ttl: float) -> str:
+        lock = self.locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            script = self.load(url)
+            if script and time.time() - script['time'] < ttl:
+                return script['source']
+            headers = {'If-None-Match': script['etag']} if script and script.get('etag') else {}
+            response = await recorder.request(method='GET', url=url, headers=headers)
+            if script and response.status_code == 304:
+                script = {**script, 'time': time.time()}
+            else:
+                response.raise_for_status()
+                script = {'source': response.text, 'etag': response.headers.get('ETag'), 'time': time.time()}
+            self.save(url, script)
+            return script['source']
+
+    def call(self, url: str, code: str, func: str, *args):
+        """在预加载url脚本的引擎中加载code并调用func，优先复用已加载相同code的引擎"""
+        pool = self.engines.setdefault(url, [])
+        for index, (engine, loaded) in enumerate(pool):
+            if loaded == code:
+                pool.pop(index)
+                break
+        else:
+            if len(pool) >= self.size:
+                engine = pool.pop(0)[0]
+            else:
+                engine = jsengine.JSEngine(self.scripts[url]['source'])
+            engine.eval(code)
+        pool.append((engine, code))
+        return engine.call(func, *args)
+
+
+js_cache = JSCache('cache')
+
+
+class LoopMonitor:
+    """定期检测事件循环被阻塞的时长"""
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = 0.0
+        self.blocked_max = 0.0
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - start - self.interval
+            self.blocked += lag
+            self.blocked_max = max(self.blocked_max, lag)
+            if lag >= self.threshold:
+                logger.warning(f'事件循环阻塞{lag:.2f}s')
+
+
+loop_monitor = LoopMonitor()
+
+
+class RecordPool:
+    """录制准入控制，限制同时录制的数量和总带宽，名额不足时按平台优先级排队"""
+
+    def __init__(self, config: dict):
+        self.max_recordings = config.get('max_recordings', 0)
+        # 带宽相关配置的单位为Mbps
+        self.max_bandwidth = config.get('max_bandwidth', 0) * 1e6
+        self.default_bitrate = config.get('default_bitrate', 8) * 1e6
+        self.executor = ThreadPoolExecutor(max_workers=self.max_recordings or 256, thread_name_prefix='recorder')
+        self.active: Dict[str, float] = {}
+        self.waiting = []
+        self.queued = set()
+        self.counter = itertools.count()
+
+    def busy(self, url: str) -> bool:
+        return url in self.active or url in self.queued
+
+    def admit(self, bitrate: float) -> bool:
+        if self.max_recordings and len(self.active) >= self.max_recordings:
+            return False
+        # 没有正在录制的直播时总是允许，避免单个直播流码率超过上限时永远无法录制
+        return not self.max_bandwidth or not self.active or sum(self.active.values()) + bitrate <= self.max_bandwidth
+
+    async def acquire(self, recorder: 'LiveRecoder', url: str) -> bool:
+        """获取录制名额，返回是否经过排队等待"""
+        bitrate = recorder.room.bitrate or self.default_bitrate
+        if not self.waiting and self.admit(bitrate):
+            self.active[url] = bitrate
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (-recorder.priority, next(self.counter), bitrate, url, future))
+        self.queued.add(url)
+        logger.warning(f'{recorder.flag}录制名额已满，等待空闲名额（录制中{len(self.active)}个，'
+                       f'占用带宽{sum(self.active.values()) / 1e6:.1f}Mbps，等待中{len(self.waiting)}个）')
+        try:
+            await future
+        finally:
+            self.queued.discard(url)
+        return True
+
+    def release(self, url: str):
+        self.active.pop(url, None)
+        while self.waiting:
+            _, _, bitrate, waiting_url, future = self.waiting[0]
+            if future.done():
+                heapq.heappop(self.waiting)
+            elif self.admit(bitrate):
+                heapq.heappop(self.waiting)
+                self.active[waiting_url] = bitrate
+                future.set_result(None)
+            else:
+                break
+
+    async def record(self, recorder: 'LiveRecoder', *args):
+        url = args[1]
+        if recorder.admitted == url:
+            # 排队后重新检测时名额已由外层占用
+            return await self.run(recorder, *args)
+        waited = await self.acquire(recorder, url)
+        try:
+            if waited:
+                # 排队期间签名的直播流链接可能已过期，占用名额重新检测直播间并解析直播流，期间下播则不再录制
+                logger.info(f'{recorder.flag}已获得录制名额，重新获取直播流')
+                recorder.admitted = url
+                stream_cache.pop(url, None)
+                try:
+                    await recorder.run()
+                finally:
+                    recorder.admitted = None
+            else:
+                await self.run(recorder, *args)
+        finally:
+            self.release(url)
+
+    async def run(self, recorder: 'LiveRecoder', *args):
+        # 录制线程沿用检测时绑定的直播间日志字段
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, contextvars.copy_context().run, recorder.run_record, *args)
+
+
+record_pool = RecordPool({})
+
+
+class Store:
+    """录制状态的SQLite存储，记录直播间状态、录制场次、录制文件和ffmpeg封装任务，
+    程序重启后据此接续同一场直播的录制并继续未完成的封装"""
+
+    def __init__(self, path: str, owner: str = ''):
+        self.owner = owner
+        self.lock = threading.Lock()
+        # 同一主机的多个工作进程共用一个数据库文件，各自只恢复自己写入的录制文件
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS rooms (room TEXT PRIMARY KEY, live_times TEXT, bitrate REAL, ssl INTEGER);
+            CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, room TEXT, stream TEXT, title TEXT, path TEXT,
+                parts INTEGER, started REAL, updated REAL, ended REAL);
+            CREATE INDEX IF NOT EXISTS sessions_room ON sessions (room, started);
+            CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, session INTEGER, part INTEGER, owner TEXT,
+                flag TEXT, target TEXT, started REAL, ended REAL, size INTEGER);
+            CREATE INDEX IF NOT EXISTS files_session ON files (session, part);
+            CREATE INDEX IF NOT EXISTS files_open ON files (owner) WHERE ended IS NULL;
+            CREATE TABLE IF NOT EXISTS postprocess (source TEXT PRIMARY KEY, flag TEXT, target TEXT, owner TEXT,
+                status TEXT, updated REAL);
+            CREATE INDEX IF NOT EXISTS postprocess_status ON postprocess (owner, status);
+        ''')
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def load_room(self, room: 'Room'):
+        if row := self.execute('SELECT live_times, bitrate, ssl FROM rooms WHERE room = ?',
+                               (f'{room.platform}/{room.id}',)):
+            live_times, room.bitrate, ssl = row[0]
+            room.live_times = tuple(json.loads(live_times))
+            room.ssl = bool(ssl)
+
+    def save_room(self, room: 'Room'):
+        self.execute('INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?)',
+                     (f'{room.platform}/{room.id}', json.dumps(room.live_times), room.bitrate, room.ssl))
+
+    def open_session(self, room: 'Room', stream: str, title: str, path: Path, window: float):
+        """返回(场次id, 文件路径, 已录制分段数)，同一直播流的上一场录制在window秒内仍有写入时视为同一场直播继续录制，
+        按直播流网址区分场次，同一频道同时进行的多场直播（如YouTube）分别录制"""
+        key = f'{room.platform}/{room.id}'
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT id, path, parts, COALESCE(ended, updated) FROM sessions '
+                                  'WHERE room = ? AND stream = ? ORDER BY started DESC LIMIT 1', (key, stream)).fetchone()
+            if row and now - row[3] <= window:
+                self.db.execute('UPDATE sessions SET ended = NULL, updated = ? WHERE id = ?', (now, row[0]))
+                return row[0], Path(row[1]).with_suffix(path.suffix), row[2]
+            cursor = self.db.execute('INSERT INTO sessions (room, stream, title, path, parts, started, updated) '
+                                     'VALUES (?, ?, ?, ?, 0, ?, ?)', (key, stream, title, str(path), now, now))
+            return cursor.lastrowid, path, 0
+
+    def close_session(self, session: int):
+        now = time.time()
+        self.execute('UPDATE sessions SET ended = ?, updated = ? WHERE id = ?', (now, now, session))
+
+    def add_file(self, session: int, path: Path, part: int, flag: str, target: str = None):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (path, session, part, owner, flag, target, started) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)', (str(path), session, part, self.owner, flag, target, now))
+            self.db.execute('UPDATE sessions SET parts = MAX(parts, ?), updated = ? WHERE id = ?', (part, now, session))
+
+    def close_file(self, path: Path, size: int):
+        now = time.time()
+        with self.lock:
+            self.db.execute('UPDATE sessions SET updated = ? WHERE id = (SELECT session FROM files WHERE path = ?)',
+                            (now, str(path)))
+            if size:
+                self.db.execute('UPDATE files SET ended = ?, size = ? WHERE path = ?', (now, size, str(path)))
+            else:
+                # 直播流未能打开时不保留空文件的记录
+                self.db.execute('DELETE FROM files WHERE path = ?', (str(path),))
+
+    def replace_file(self, source: str, target: str):
+        """封装完成后原始录制文件已删除，录制记录改为指向封装后的文件"""
+        self.execute('UPDATE OR REPLACE files SET path = ?, target = NULL, size = ? WHERE path = ?',
+                     (target, os.path.getsize(target), source))
+
+    def recover(self):
+        """程序异常退出后补全未关闭的录制文件，以最后写入时间作为结束时间，需要封装的文件加入封装队列"""
+        with self.lock:
+            rows = self.db.execute('SELECT path, session, flag, target FROM files WHERE ended IS NULL AND owner = ?',
+                                   (self.owner,)).fetchall()
+            for path, session, flag, target in rows:
+                stat = os.stat(path) if os.path.exists(path) else None
+                ended = stat.st_mtime if stat else time.time()
+                self.db.execute('UPDATE files SET ended = ?, size = ? WHERE path = ?',
+                                (ended, stat.st_size if stat else 0, path))
+                self.db.execute('UPDATE sessions SET ended = ?, updated = ? WHERE id = ? AND ended IS NULL',
+                                (ended, ended, session))
+                if target and stat and stat.st_size:
+                    self.db.execute('INSERT OR IGNORE INTO postprocess VALUES (?, ?, ?, ?, ?, ?)',
+                                    (path, flag, target, self.owner, 'pending', time.time()))
+        return len(rows)
+
+
+store = Store(':memory:')
+
+
+class PostProcessor:
+    """录制结束后的ffmpeg封装任务队列，任务状态记录在状态数据库中，重启后继续处理未完成的任务"""
+
+    def __init__(self, config: dict):
+        # 封装由ffmpeg子进程完成，线程仅负责等待，线程数即同时运行的ffmpeg数量
+        workers = config.get('ffmpeg_workers', max(1, (os.cpu_count() or 2) // 2))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ffmpeg')
+        self.jobs: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def resume(self):
+        # 同一主机的其他工作进程可能仍在处理各自的任务，只继续本进程提交的任务
+        for source, flag, target in store.execute(
+                "SELECT source, flag, target FROM postprocess WHERE owner = ? AND status = 'pending'", (store.owner,)):
+            if os.path.exists(source):
+                logger.info(f'{flag}继续未完成的ffmpeg封装：{source}')
+                self.submit(flag, source, target)
+            else:
+                store.execute("UPDATE postprocess SET status = 'missing', updated = ? WHERE source = ?",
+                              (time.time(), source))
+
+    def submit(self, flag: str, source: str, target: str):
+        job = {'flag': flag, 'source': source, 'target': target}
+        with self.lock:
+            self.jobs[source] = job
+        store.execute('INSERT OR REPLACE INTO postprocess VALUES (?, ?, ?, ?, ?, ?)',
+                      (source, flag, target, store.owner, 'pending', time.time()))
+        self.executor.submit(self.remux, job)
+
+    def remux(self, job: dict):
+        logger.info(f'{job["flag"]}开始ffmpeg封装：{job["source"]}')
+        status = 'failed'
+        try:
+            storage.wait_space(Path(job['target']), os.path.getsize(job['source']), job['flag'])
+            ffmpeg.input(job['source']).output(
+                job['target'],
+                codec='copy',
+                map_metadata='-1',
+                movflags='faststart'
+            ).global_args('-hide_banner').overwrite_output().run()
+            os.remove(job['source'])
+            store.replace_file(job['source'], job['target'])
+            status = 'done'
+            storage.offload(Path(job['target']))
+            logger.info(f'{job["flag"]}ffmpeg封装完成：{job["target"]}')
+        except Exception as error:
+            logger.error(f'{job["flag"]}ffmpeg封装错误，已保留原始录制文件：{job["source"]}\n{repr(error)}')
+        finally:
+            store.execute('UPDATE postprocess SET status = ?, updated = ? WHERE source = ?',
+                          (status, time.time(), job['source']))
+            with self.lock:
+                self.jobs.pop(job['source'], None)
+
+
+postprocessor = PostProcessor({})
+
+
+class Storage:
+    """录制输出目录管理：统计各目录的剩余空间和写入速率并预测写满时间，按预测结果分配新录制的输出目录，
+    以及在后台限速将录制完成的文件转移到归档目录"""
+
+    def __init__(self, config: dict):
+        self.volumes = [Path(volume) for volume in config.get('output_volumes', [])]
+        # 空间相关配置，min_free_space单位为GB，disk_warn_time单位为秒
+        self.reserve = config.get('min_free_space', 1) * 1024 ** 3
+        self.warn_time = config.get('disk_warn_time', 3600)
+        archive = config.get('archive') or {}
+        self.archive = Path(archive['path']) if archive.get('path') else None
+        # 归档复制速率上限，单位MB/s，0为不限制
+        self.bandwidth = archive.get('bandwidth', 0) * 1024 * 1024
+        self.executor = ThreadPoolExecutor(max_workers=archive.get('workers', 1), thread_name_prefix='archive')
+        self.samples: Dict[str, Tuple[float, int]] = {}
+        # 各目录的(剩余空间, 写入速率, 预计写满秒数)
+        self.stats: Dict[Path, Tuple[int, float, float]] = {}
+
+    @staticmethod
+    def free(path: Path) -> int:
+        while not path.exists() and path != path.parent:
+            path = path.parent
+        return shutil.disk_usage(path).free
+
+    def volume(self, path: Path) -> Path:
+        for volume in self.volumes:
+            if path.is_relative_to(volume):
+                return volume
+        return path.parent
+
+    def time_to_full(self, volume: Path) -> float:
+        free, rate, _ = self.stats.get(volume, (0, 0.0, 0))
+        return (self.free(volume) - self.reserve) / rate if rate else float('inf')
+
+    def choose(self, bitrate: float) -> Path:
+        # 选择预计最晚写满的目录，均未在录制时选择剩余空间最多的目录
+        volume = max(self.volumes, key=lambda volume: (self.time_to_full(volume), self.free(volume)))
+        free = self.free(volume)
+        if free < self.reserve:
+            logger.warning(f'所有输出目录的剩余空间均不足{self.reserve / 1024 ** 3:.0f}GB')
+        # 在下次统计前先计入新录制的预估写入速率，避免同时开播的直播间集中到同一目录
+        rate = self.stats.get(volume, (0, 0.0, 0))[1] + bitrate / 8
+        self.stats[volume] = (free, rate, (free - self.reserve) / rate)
+        return volume
+
+    def update(self):
+        now = time.monotonic()
+        rates: Dict[Path, float] = {volume: 0.0 for volume in self.volumes}
+        for url, (_, output) in recording.copy().items():
+            part = getattr(output, 'part', output)
+            if not part or not hasattr(part, 'filename'):
+                continue
+            written = output.written
+            last_time, last_written = self.samples.get(url, (now, written))
+            self.samples[url] = (now, written)
+            volume = self.volume(Path(part.filename))
+            rates[volume] = rates.get(volume, 0.0) + (written - last_written) / max(now - last_time, 1e-3)
+        for url in set(self.samples) - set(recording):
+            self.samples.pop(url)
+        stats = {}
+        for volume, rate in rates.items():
+            free = self.free(volume)
+            stats[volume] = (free, rate, (free - self.reserve) / rate if rate else float('inf'))
+            if stats[volume][2] < self.warn_time:
+                logger.warning(f'输出目录{volume}剩余{free / 1024 ** 3:.1f}GB，按当前写入速率{rate / 1024 / 1024:.1f}MB/s'
+                               f'预计{max(stats[volume][2], 0) / 60:.0f}分钟后写满')
+        self.stats = stats
+
+    async def run(self, interval: float = 10):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.update)
+            except Exception as error:
+                logger.error(f'输出目录统计错误\n{repr(error)}')
+
+    def wait_space(self, path: Path, size: int, flag: str):
+        """阻塞等待目录剩余空间足够写入size字节，用于ffmpeg封装前的检查"""
+        warned = False
+        while self.free(path.parent) < size + self.reserve:
+            if not warned:
+                logger.warning(f'{flag}剩余空间不足，等待空间释放后再进行ffmpeg封装：{path}')
+                warned = True
+            time.sleep(60)
+
+    def offload(self, path: Path):
+        if self.archive:
+            self.executor.submit(self.move, path)
+
+    def move(self, source: Path):
+        volume = next((volume for volume in self.volumes if source.is_relative_to(volume)), None)
+        target = self.archive / (source.relative_to(volume) if volume else source.name)
+        temp = target.with_name(f'{target.name}.part')
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            start_time = time.monotonic()
+            copied = 0
+            with source.open('rb') as src, temp.open('wb') as dst:
+                while chunk := src.read(1024 * 1024):
+                    dst.write(chunk)
+                    copied += len(chunk)
+                    # 限制复制速率，避免占用录制所需的磁盘带宽
+                    if self.bandwidth and (delay := copied / self.bandwidth - (time.monotonic() - start_time)) > 0:
+                        time.sleep(delay)
+                dst.flush()
+                os.fsync(dst.fileno())
+            shutil.copystat(source, temp)
+            os.replace(temp, target)
+            source.unlink()
+            store.execute('UPDATE files SET path = ? WHERE path = ?', (str(target), str(source)))
+            logger.info(f'录制文件已转移到归档目录：{target}')
+        except Exception as error:
+            temp.unlink(missing_ok=True)
+            logger.error(f'录制文件转移到归档目录失败，已保留原文件：{source}\n{repr(error)}')
+
+
+storage = Storage({})
+
+
+class Metrics:
+    """以Prometheus文本格式在本地HTTP端口提供运行指标"""
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], list] = {}
+        self.scheduler = None
+        self.samples: Dict[str, Tuple[float, int]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        # 各分桶计数，最后两项为总和与总数
+        histogram = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @staticmethod
+    def line(name: str, labels, value) -> str:
+        labels = ','.join(f'{k}={json.dumps(str(v), ensure_ascii=False)}' for k, v in labels)
+        value = '+Inf' if value == float('inf') else value
+        return f'live_recorder_{name}{{{labels}}} {value}' if labels else f'live_recorder_{name} {value}'
+
+    def gauges(self):
+        now = time.monotonic()
+        yield 'recordings_active', (), len(recording)
+        for url, (_, output) in recording.copy().items():
+            written = getattr(output, 'written', 0)
+            last_time, last_written = self.samples.get(url, (now, written))
+            self.samples[url] = (now, written)
+            yield 'recording_bytes_total', (('url', url),), written
+            yield 'recording_bytes_per_second', (('url', url),), (written - last_written) / max(now - last_time, 1e-3)
+        for url in set(self.samples) - set(recording):
+            self.samples.pop(url)
+        yield 'recordings_waiting', (), len(record_pool.waiting)
+        yield 'ffmpeg_queue_depth', (), len(postprocessor.jobs)
+        for volume, (free, rate, time_to_full) in storage.stats.items():
+            yield 'disk_free_bytes', (('path', volume),), free
+            yield 'disk_write_bytes_per_second', (('path', volume),), rate
+            yield 'disk_seconds_to_full', (('path', volume),), time_to_full
+        yield 'event_loop_blocked_seconds_total', (), loop_monitor.blocked
+        yield 'event_loop_blocked_seconds_max', (), loop_monitor.blocked_max
+        if self.scheduler:
+            yield 'scheduler_lag_seconds', (), self.scheduler.lag
+            yield 'scheduler_queue_size', (), len(self.scheduler.queue)
+
+    def render(self) -> str:
+        lines = [self.line(name, labels, value) for name, labels, value in self.gauges()]
+        for (name, labels), value in self.counters.copy().items():
+            lines.append(self.line(name, labels, value))
+        for (name, labels), histogram in self.histograms.copy().items():
+            for bucket, count in zip(self.buckets, histogram):
+                lines.append(self.line(f'{name}_bucket', labels + (('le', bucket),), count))
+            lines.append(self.line(f'{name}_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+            lines.append(self.line(f'{name}_sum', labels, histogram[-2]))
+            lines.append(self.line(f'{name}_count', labels, histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'运行指标已启动：http://{host}:{port}/metrics')
+        return server
+
+
+metrics = Metrics()
+
+
+class FFmpegOutput(FileOutput):
+    """将直播流通过管道交给ffmpeg，录制的同时完成封装"""
+
+    def __init__(self, filename: Path, **kwargs):
+        super().__init__(filename)
+        self.kwargs = kwargs
+        self.process = None
+        self.written = 0
+
+    def _open(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.process = ffmpeg.input('pipe:').output(str(self.filename), **self.kwargs).global_args(
+            '-hide_banner', '-loglevel', 'error').overwrite_output().run_async(pipe_stdin=True)
+        self.fd = self.process.stdin
+
+    def _write(self, data):
+        self.fd.write(data)
+        self.written += len(data)
+
+    def _close(self):
+        self.fd.close()
+        self.process.wait()
+
+
+class BufferedFileOutput(FileOutput):
+    """使用大缓冲区写入录制文件，可选按块预分配磁盘空间和在后台线程定期fsync"""
+
+    def __init__(self, filename: Path, buffer_size: int = 0, preallocate: int = 0, fsync_interval: float = 0):
+        super().__init__(filename)
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate if hasattr(os, 'posix_fallocate') else 0
+        self.fsync_interval = fsync_interval
+        self.allocated = 0
+        self.written = 0
+        self.stopped = threading.Event()
+
+    def _open(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = self.filename.open('wb', buffering=self.buffer_size or -1)
+        if self.fsync_interval:
+            threading.Thread(target=self.sync, daemon=True).start()
+
+    def _write(self, data):
+        while self.preallocate and self.written + len(data) > self.allocated:
+            os.posix_fallocate(self.fd.fileno(), self.allocated, self.preallocate)
+            self.allocated += self.preallocate
+        self.fd.write(data)
+        self.written += len(data)
+
+    def sync(self):
+        # 仅同步已写入系统的数据，不在录制线程中阻塞等待磁盘
+        while not self.stopped.wait(self.fsync_interval):
+            try:
+                os.fsync(self.fd.fileno())
+            except (OSError, ValueError):
+                break
+
+    def _close(self):
+        self.stopped.set()
+        if self.allocated:
+            # 截掉预分配但未写入的部分
+            self.fd.flush()
+            self.fd.truncate(self.written)
+        self.fd.close()
+        if not self.written:
+            # 直播流未能打开时删除提前创建的空文件
+            self.filename.unlink(missing_ok=True)
+
+
+def open_stream(stream):
+    """打开直播流并预读8192字节检查是否有数据，
+    streamlink_cli的同名函数通过全局变量返回读取对象，多个直播同时打开时会拿到其他直播的读取对象"""
+    try:
+        stream_fd = stream.open()
+    except StreamError as error:
+        raise StreamError(f'Could not open stream: {error}') from error
+    try:
+        prebuffer = stream_fd.read(8192)
+    except OSError as error:
+        stream_fd.close()
+        raise StreamError(f'Failed to read data from stream: {error}') from error
+    if not prebuffer:
+        stream_fd.close()
+        raise StreamError('No data returned from stream')
+    return stream_fd, prebuffer
+
+
+def day_seconds():
+    now = time.localtime()
+    return now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec
+
+
+class TokenBucket:
+    """令牌桶限流，rate为每秒允许的检测次数，0表示不限制"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        # 桶容量至少为1个令牌，否则每秒不足1次的限制永远无法获取令牌
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.time = time.monotonic()
+
+    def wait(self) -> float:
+        """返回获取下一个令牌需要等待的秒数"""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class Scheduler:
+    """统一管理所有直播间的下次检测时间，按到期时间依次调度检测"""
+
+    def __init__(self, config: dict):
+        self.jitter = config.get('jitter', 0.1)
+        self.max_interval = config.get('max_interval', 300)
+        # 默认不因长时间未开播放慢检测，避免开播后最多延迟max_interval才发现
+        self.offline_backoff = config.get('offline_backoff', 0)
+        self.budget = TokenBucket(config.get('rate_limit', 0))
+        self.platform_budgets = {
+            platform: TokenBucket(rate) for platform, rate in config.get('platform_rate_limit', {}).items()
+        }
+        self.queue = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        self.running = set()
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.deferred = 0
+
+    def add(self, room: 'Room', delay: float = 0):
+        heapq.heappush(self.queue, (time.monotonic() + delay, next(self.counter), room))
+        self.wakeup.set()
+
+    def remove(self, room: 'Room'):
+        # 仅做标记，已在队列中的直播间到期时跳过，正在检测或录制的直播间结束后不再调度
+        room.removed = True
+
+    def delay(self, room: 'Room') -> float:
+        # 斗鱼已开播但未获取到直播流时快速重试
+        if room.mState == '1':
+            return 2
+        interval = room.interval
+        if room.failures:
+            # 连续检测出错时指数退避
+            interval *= 2 ** min(room.failures, 6)
+        elif room.near_live_time():
+            # 临近主播常用开播时间时加快检测
+            interval /= 2
+        elif self.offline_backoff and room.offline_since:
+            # 长时间未开播时指数退避
+            interval *= 2 ** min(int((time.time() - room.offline_since) / self.offline_backoff), 6)
+        interval = min(interval, max(self.max_interval, room.interval))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def check(self, room: 'Room'):
+        self.running.add(room)
+        try:
+            # 录制对象仅在检测和录制期间存在，结束后只保留直播间状态
+            with logger.contextualize(room=room.id, platform=room.platform):
+                await room.create().check()
+        except Exception as error:
+            # 创建录制对象或连接池出错（如代理地址无效）时按检测出错退避，不能让直播间离开调度队列
+            logger.error(f'{room.flag}直播检测内部错误\n{repr(error)}')
+            room.failures += 1
+        finally:
+            room.recorder = None
+            self.running.discard(room)
+            if room.removed:
+                logger.info(f'{room.flag}已停止检测')
+            else:
+                delay = self.delay(room)
+                # 每次检测都会输出的日志使用DEBUG级别并延迟格式化，未开启DEBUG时几乎没有开销
+                logger.debug('{}->直播状态：{}  实际刷新间隔：{:.1f}s', room.flag, room.mState, delay)
+                self.add(room, delay)
+
+    async def run(self):
+        report_time = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - report_time >= 60:
+                logger.info(f'调度统计：最大调度延迟{self.lag_max:.2f}s，限流延后{self.deferred}次')
+                report_time, self.lag_max, self.deferred = now, 0.0, 0
+            self.wakeup.clear()
+            if not self.queue:
+                await self.wakeup.wait()
+                continue
+            due, _, room = self.queue[0]
+            if due > now:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(due - now, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.queue)
+            if room.removed:
+                logger.info(f'{room.flag}已停止检测')
+                continue
+            # 平台和全局的检测频率超出限制时延后检测
+            budgets = [self.budget]
+            if platform_budget := self.platform_budgets.get(room.platform):
+                budgets.append(platform_budget)
+            if wait := max(budget.wait() for budget in budgets):
+                self.deferred += 1
+                heapq.heappush(self.queue, (now + wait, next(self.counter), room))
+                continue
+            for budget in budgets:
+                budget.take()
+            self.lag = now - due
+            self.lag_max = max(self.lag_max, self.lag)
+            task = asyncio.create_task(self.check(room))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+class ContinuousHLSWorker(HLSStreamWorker):
+    """重新连接后从上次写入的下一个分片继续，已写入的分片不再重复写入"""
+
+    def process_segments(self, playlist):
+        start = self.playlist_sequence < 0
+        super().process_segments(playlist)
+        written = getattr(self.stream, 'written_sequence', -1)
+        if start and written >= 0:
+            first, last = playlist.segments[0].num, playlist.segments[-1].num
+            if first <= written + 1 <= last + 1:
+                self.playlist_sequence = written + 1
+            elif written + 1 < first:
+                # 中断期间的分片已不在播放列表中，从最早的分片开始减少缺失
+                self.playlist_sequence = first
+            else:
+                # 分片编号与上次不连续，视为新的播放列表
+                self.stream.written_sequence = -1
+
+
+class ContinuousHLSWriter(HLSStreamWriter):
+    def write(self, segment, result, *data):
+        super().write(segment, result, *data)
+        if not (data and data[0]):
+            self.stream.written_sequence = segment.num
+
+
+class ContinuousHLSReader(HLSStreamReader):
+    __worker__ = ContinuousHLSWorker
+    __writer__ = ContinuousHLSWriter
+
+
+class FlvTagReader:
+    """只返回完整FLV标签的直播流读取对象，连接中断时丢弃最后不完整的标签，
+    重新连接后的数据从标签边界处接续，保证录制文件的标签链完整，时间戳接续上次连接"""
+
+    def __init__(self, stream_fd, previous: 'FlvTagReader' = None):
+        self.stream_fd = stream_fd
+        # 重新连接时去掉新连接的FLV文件头，标签时间戳从上次连接最后写入的时间戳之后开始
+        self.header = previous is None
+        self.offset = previous.last + previous.step if previous else None
+        self.base = None
+        # 已返回标签的最大时间戳和相邻标签的时间戳间隔（毫秒）
+        self.last = 0
+        self.step = 0
+        self.buffer = bytearray()
+        # 下一个标签在缓冲区中的起始位置，为None时不是FLV数据，直接透传
+        self.pos = 0
+        self.started = False
+
+    def align(self, data: bytes) -> bytes:
+        """追加数据并返回已完整的部分"""
+        buffer = self.buffer
+        buffer += data
+        if self.pos is None:
+            data = bytes(buffer)
+            buffer.clear()
+            return data
+        if not self.started:
+            if len(buffer) < 9:
+                return b''
+            if buffer[:3] != b'FLV':
+                self.pos = None
+                return self.align(b'')
+            size = int.from_bytes(buffer[5:9], 'big') + 4
+            if len(buffer) < size:
+                return b''
+            self.started = True
+            if self.header:
+                self.pos = size
+            else:
+                del buffer[:size]
+        while len(buffer) - self.pos >= 11:
+            if buffer[self.pos] & 0x1f not in (8, 9, 18):
+                self.pos = None
+                return self.align(b'')
+            end = self.pos + 11 + int.from_bytes(buffer[self.pos + 1:self.pos + 4], 'big') + 4
+            if len(buffer) < end:
+                break
+            self.rebase(buffer, self.pos)
+            self.pos = end
+        data = bytes(buffer[:self.pos])
+        del buffer[:self.pos]
+        self.pos = 0
+        return data
+
+    def rebase(self, buffer: bytearray, pos: int):
+        # 标签头第4至6字节为时间戳低24位，第7字节为高8位
+        timestamp = int.from_bytes(buffer[pos + 4:pos + 7], 'big') | buffer[pos + 7] << 24
+        if self.offset is not None:
+            if self.base is None:
+                self.base = self.offset - timestamp
+            timestamp = max(timestamp + self.base, 0) & 0xffffffff
+            buffer[pos + 4:pos + 7] = (timestamp & 0xffffff).to_bytes(3, 'big')
+            buffer[pos + 7] = timestamp >> 24
+        if 0 < timestamp - self.last <= 1000:
+            self.step = timestamp - self.last
+        self.last = max(self.last, timestamp)
+
+    def read(self, size: int = -1) -> bytes:
+        while data := self.stream_fd.read(size):
+            if data := self.align(data):
+                return data
+        # 直播流结束时缓冲区中只剩不完整的标签
+        self.buffer.clear()
+        return b''
+
+    def close(self):
+        self.stream_fd.close()
+
+
+# PMT中的视频流类型：MPEG-1/2、MPEG-4、H.264、HEVC、AVS、VC-1
+TS_VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1b, 0x24, 0x42, 0xea}
+
+
+class SegmentedOutput(Output):
+    """按大小或时长切分录制文件，FLV在视频关键帧标签处切分，TS在视频流带随机访问标志的关键帧包处切分，
+    每个分段开头补写文件头和编码参数，保证单独可播放"""
+
+    def __init__(self, format: str, open_part, close_part, max_size: float = 0, max_duration: float = 0):
+        super().__init__()
+        self.format = format if format in ('flv', 'ts') else None
+        self.open_part = open_part
+        self.close_part = close_part
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self.buffer = bytearray()
+        self.headers: Dict[str, bytes] = {}
+        self.pmt_pid = None
+        self.video_pids = set()
+        self.random_access = False
+        self.part = None
+        self.index = 0
+        # 本输出内切分过分段后新分段需补写文件头，继续录制时的首个分段由直播流自带文件头
+        self.cut = False
+        self.part_size = 0
+        self.part_time = 0
+        self.written = 0
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        if self.buffer:
+            self.emit(bytes(self.buffer), False)
+            self.buffer.clear()
+        self.finish_part()
+
+    def _write(self, data):
+        if not self.format:
+            self.emit(data, False)
+            return
+        self.buffer += data
+        for unit, keyframe in (self.parse_flv() if self.format == 'flv' else self.parse_ts()):
+            self.emit(unit, keyframe)
+
+    def emit(self, data: bytes, keyframe: bool):
+        if keyframe and self.part and (
+                self.max_size and self.part_size >= self.max_size or
+                self.max_duration and time.monotonic() - self.part_time >= self.max_duration):
+            self.finish_part()
+        if not self.part:
+            self.index += 1
+            self.part = self.open_part(self.index)
+            self.part.open()
+            self.part_size = 0
+            self.part_time = time.monotonic()
+            if self.cut:
+                self.part.write(b''.join(self.headers.values()))
+        self.part.write(data)
+        self.part_size += len(data)
+        self.written += len(data)
+
+    def finish_part(self):
+        if self.part:
+            self.part.close()
+            self.close_part(self.part)
+            self.part = None
+            self.cut = True
+
+    def passthrough(self):
+        # 无法解析时不再切分，直接写入剩余数据
+        self.format = None
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return [(data, False)]
+
+    def parse_flv(self):
+        units = []
+        buffer = self.buffer
+        pos = 0
+        if 'header' not in self.headers:
+            if len(buffer) < 13:
+                return units
+            if buffer[:3] != b'FLV':
+                return self.passthrough()
+            pos = int.from_bytes(buffer[5:9], 'big') + 4
+            self.headers['header'] = bytes(buffer[:pos])
+            units.append((self.headers['header'], False))
+        while len(buffer) - pos >= 11:
+            tag_type = buffer[pos] & 0x1f
+            if tag_type not in (8, 9, 18):
+                del buffer[:pos]
+                return units + self.passthrough()
+            end = pos + 11 + int.from_bytes(buffer[pos + 1:pos + 4], 'big') + 4
+            if len(buffer) < end:
+                break
+            tag = bytes(buffer[pos:end])
+            keyframe = False
+            if tag_type == 18:
+                self.headers.setdefault('script', tag)
+            elif tag_type == 9 and end - pos > 17:
+                flags = buffer[pos + 11]
+                if flags & 0x80:
+                    # Enhanced FLV（HEVC/AV1等），低4位为包类型，0为序列头
+                    sequence_header = flags & 0x0f == 0
+                    keyframe = (flags >> 4) & 0x07 == 1
+                else:
+                    sequence_header = flags & 0x0f in (7, 12) and buffer[pos + 12] == 0
+                    keyframe = flags >> 4 == 1
+                if sequence_header:
+                    self.headers['video'] = tag
+                    keyframe = False
+            elif tag_type == 8 and end - pos > 17 and buffer[pos + 11] >> 4 == 10 and buffer[pos + 12] == 0:
+                self.headers['audio'] = tag
+            units.append((tag, keyframe))
+            pos = end
+        del buffer[:pos]
+        return units
+
+    def parse_ts(self):
+        units = []
+        buffer = self.buffer
+        pos = 0
+        while len(buffer) - pos >= 188:
+            if buffer[pos] != 0x47:
+                del buffer[:pos]
+                return units + self.passthrough()
+            packet = bytes(buffer[pos:pos + 188])
+            pid = (packet[1] & 0x1f) << 8 | packet[2]
+            payload_start = packet[1] & 0x40
+            adaptation = packet[3] & 0x20 and packet[4] > 0
+            keyframe = False
+            if pid == 0:
+                self.headers['pat'] = packet
+                if payload_start:
+                    offset = 4 + (packet[4] + 1 if packet[3] & 0x20 else 0)
+                    entry = offset + 1 + packet[offset] + 8
+                    # 跳过节目号为0的网络信息表，取第一个节目的PMT
+                    while entry + 4 <= 188 and not int.from_bytes(packet[entry:entry + 2], 'big'):
+                        entry += 4
+                    if entry + 4 <= 188:
+                        self.pmt_pid = (packet[entry + 2] & 0x1f) << 8 | packet[entry + 3]
+                # 未出现随机访问标志时退而在PAT处切分，HLS分片均以PAT开头
+                keyframe = not self.random_access
+            elif pid == self.pmt_pid:
+                self.headers['pmt'] = packet
+                if payload_start:
+                    self.parse_pmt(packet)
+            elif payload_start and adaptation and packet[5] & 0x40 and (pid in self.video_pids or not self.video_pids):
+                # 音频帧通常每帧都带随机访问标志，有视频流时只在视频关键帧处切分
+                self.random_access = True
+                keyframe = True
+            units.append((packet, keyframe))
+            pos += 188
+        del buffer[:pos]
+        return units
+
+    def parse_pmt(self, packet: bytes):
+        offset = 4 + (packet[4] + 1 if packet[3] & 0x20 else 0)
+        start = offset + 1 + packet[offset]
+        if start + 12 > 188:
+            return
+        # 节目信息之后为各基本流的类型和PID，段末4字节为CRC
+        end = min(start + 3 + ((packet[start + 1] & 0x0f) << 8 | packet[start + 2]) - 4, 188)
+        entry = start + 12 + ((packet[start + 10] & 0x0f) << 8 | packet[start + 11])
+        video_pids = set()
+        while entry + 5 <= end:
+            if packet[entry] in TS_VIDEO_STREAM_TYPES:
+                video_pids.add((packet[entry + 1] & 0x1f) << 8 | packet[entry + 2])
+            entry += 5 + ((packet[entry + 3] & 0x0f) << 8 | packet[entry + 4])
+        self.video_pids = video_pids
+
+
+class Room:
+    """直播间的常驻状态，调度器只持有该记录，检测或录制时才创建对应平台的录制对象"""
+    __slots__ = ('id', 'platform', 'config', 'user', 'recorder', 'ssl', 'mState', 'failures', 'offline_since',
+                 'live_times', 'removed', 'js_enc', 'js_enc_time', 'bitrate', 'validators')
+
     def __init__(self, config: dict, user: dict):
         self.id = user['id']
-        platform = user['platform']
+        self.platform = user['platform']
+        self.config = config
+        self.user = user
+        # 正在检测或录制时对应的录制对象
+        self.recorder = None
+        self.ssl = True
+        self.mState = 0
+        # 调度相关状态：连续出错次数、未开播起始时间、最近开播时间（当天秒数，最多保留10个）
+        self.failures = 0
+        self.offline_since = time.time()
+        self.live_times = ()
+        self.removed = False
+        self.js_enc = ''
+        self.js_enc_time = 0
+        # 最近一次录制测得的直播流码率（bit/s），用于录制准入的带宽估算
+        self.bitrate = 0
+        # 未开播时直播间页面的ETag和Last-Modified，用于条件请求
+        self.validators = None
+
+    @property
+    def flag(self):
+        return f'[{self.platform}][{self.user.get("name", self.id)}]'
+
+    @property
+    def interval(self):
+        return self.user.get('interval', 10)
+
+    def configure(self, config: dict, user: dict):
+        # 正在检测或录制的录制对象保留创建时的配置，分段、输出格式等设置中途改变会导致录制文件无法正确关闭和封装，
+        # 新配置在下一次检测创建录制对象时生效
+        self.config = config
+        self.user = user
+
+    def create(self) -> 'LiveRecoder':
+        self.recorder = globals()[self.platform](self)
+        return self.recorder
+
+    def near_live_time(self, window=900):
+        now = day_seconds()
+        return any(abs((now - live_time + 43200) % 86400 - 43200) <= window for live_time in self.live_times)
+
+
+class LiveRecoder:
+    # 单次批量状态查询的最大直播间数量，0表示平台不支持批量查询
+    batch_limit = 0
+
+    def __init__(self, room: Room):
+        self.room = room
+        self.id = room.id
+        self.platform = room.platform
+        # 本次检测开始的时间，用于统计开播到开始写入的耗时
+        self.check_time = 0
+        # 当前录制场次及开始录制前已有的分段数
+        self.session = None
+        self.parts = 0
+        # 排队获得录制名额后重新检测时，已占用名额的直播间网址
+        self.admitted = None
+        self.configure(room.config, room.user)
+
+    def configure(self, config: dict, user: dict):
+        """应用配置，配置文件重新加载后在下一次检测时生效，不影响正在进行的录制"""
         name = user.get('name', self.id)
-        self.flag = f'[{platform}][{name}]'
-        
+        self.flag = f'[{self.platform}][{name}]'
+
         self.interval = user.get('interval', 10)
         self.crypto_js_url = user.get('crypto_js_url', '')
         self.headers = user.get('headers', {'User-Agent': 'Chrome'})
@@ -40,72 +1223,160 @@ class LiveRecoder:
         self.format = user.get('format')
         self.proxy = user.get('proxy', config.get('proxy'))
         self.output = user.get('output', config.get('output', 'output'))
+        self.batch_size = min(config.get('batch_size', 50), self.batch_limit)
+        self.batch_window = config.get('batch_window', 1)
         if not self.crypto_js_url:
             self.crypto_js_url = 'https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.1.1/crypto-js.min.js'
+        self.js_ttl = config.get('js_ttl', 86400)
+        self.js_enc_ttl = config.get('js_enc_ttl', 600)
+        self.resolve_timeout = config.get('resolve_timeout', 30)
+        self.stream_cache_ttl = config.get('stream_cache_ttl', 60)
+        self.priority = user.get('priority', config.get('priority', {}).get(self.platform, 0))
+        self.remux_live = user.get('remux_live', config.get('remux_live', False))
+        # 分段录制配置，segment_size单位为MB，segment_duration单位为秒，0为不分段
+        self.segment_size = user.get('segment_size', config.get('segment_size', 0)) * 1024 * 1024
+        self.segment_duration = user.get('segment_duration', config.get('segment_duration', 0))
+        # 写入相关配置，write_buffer和preallocate单位为MB，无终端时默认不显示进度条
+        self.progress = config.get('progress', sys.stderr.isatty())
+        self.write_buffer = int(config.get('write_buffer', 0) * 1024 * 1024)
+        self.preallocate = int(config.get('preallocate', 0) * 1024 * 1024)
+        self.fsync_interval = config.get('fsync_interval', 0)
+        self.resume_window = config.get('resume_window', 300)
+        # 直播流中断后的重新连接次数和首次重试间隔（秒），每次重试间隔翻倍
+        self.reconnect_attempts = user.get('reconnect_attempts', config.get('reconnect_attempts', 3))
+        self.reconnect_delay = config.get('reconnect_delay', 1)
         self.get_cookies()
-        self.client = self.get_client()
 
-    async def start(self):
-        self.ssl = True
-        self.mState = 0
-        while True:
-            try:
-                logger.info(f'{self.flag}正在检测直播状态')
-                logger.info(f'预配置刷新间隔：{self.interval}s')
+    @property
+    def client_key(self):
+        return self.proxy, self.room.ssl, self.platform
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # 同一平台且代理配置相同的直播间共用一个连接池，HTTP/2下同一主机的请求复用单个连接
+        if self.client_key not in clients:
+            clients[self.client_key] = self.get_client()
+        return clients[self.client_key]
+
+    async def check(self):
+        client = self.client
+        try:
+            logger.debug('{}正在检测直播状态，预配置刷新间隔：{}s', self.flag, self.interval)
+            self.check_time = time.monotonic()
+            await self.run()
+            self.room.failures = 0
+            if self.room.near_live_time():
                 try:
-                    await self.run()   
-                except Exception as run_error:
-                    logger.error(f"{self.flag}直播检测内部错误\n{repr(run_error)}")
-                state = self.mState
-                timeI = self.interval
-                if state == '1':
-                    timeI = 2
-                logger.info(f'->直播状态：{state}  实际刷新间隔：{timeI}s')
-                await asyncio.sleep(timeI)
-            except ConnectionError as error:
-                if '直播检测请求协议错误' not in str(error):
-                    logger.error(error)
-                await self.client.aclose()
-                self.client = self.get_client()
-            except Exception as error:
-                logger.exception(f'{self.flag}直播检测错误\n{repr(error)}')
+                    await self.prepare()
+                except Exception as error:
+                    logger.warning(f'{self.flag}预先准备录制失败\n{repr(error)}')
+        except ConnectionError as error:
+            if '直播检测请求协议错误' not in str(error):
+                logger.error(error)
+            self.reset_client(client)
+            self.room.failures += 1
+        except Exception as error:
+            logger.error(f'{self.flag}直播检测内部错误\n{repr(error)}')
+            self.room.failures += 1
 
     async def run(self):
         pass
 
-    async def request(self, method, url, **kwargs):
+    async def prepare(self):
+        """临近常用开播时间时预先准备录制所需的streamlink会话，由平台按需补充签名数据等"""
+        await self.resolve(self.get_streamlink)
+
+    async def get_status(self):
+        """批量查询当前直播间的状态，同一批次的直播间共享一次请求，平台不支持批量查询时返回None"""
+        if not self.batch_size:
+            return None
+        # 请求头和cookie不同的直播间分别批量查询，避免一个直播间的cookie随其他直播间的请求发送
+        key = (*self.client_key, json.dumps([self.headers, self.cookies], sort_keys=True))
+        if key not in batchers:
+            batchers[key] = StatusBatcher(self.batch_size, self.batch_window)
+        return await batchers[key].get(self)
+
+    async def get_status_batch(self, ids):
+        """返回{直播间id: 状态数据}，由支持批量查询的平台实现"""
+        return {}
+
+    async def request(self, method, url, stream=False, **kwargs):
+        # 请求头和cookie按直播间单独传递，避免共享连接池时互相覆盖，cookie与连接池中服务器设置的cookie合并
+        kwargs['headers'] = {**self.headers, **kwargs.get('headers', {})}
+        kwargs.setdefault('timeout', self.interval)
+        start_time = time.monotonic()
         try:
-            response = await self.client.request(method, url, **kwargs)
+            request = self.client.build_request(method, url, cookies=self.cookies, **kwargs)
+            # stream为True时只读取响应头，响应体由调用方按需读取并负责关闭
+            response = await self.client.send(request, stream=stream)
             return response
         except httpx.ProtocolError as error:
+            metrics.inc('request_errors_total', platform=self.platform, room=self.id, error=type(error).__name__)
             raise ConnectionError(f'{self.flag}直播检测请求协议错误\n{error}')
         except httpx.HTTPStatusError as error:
+            metrics.inc('request_errors_total', platform=self.platform, room=self.id, error=type(error).__name__)
             raise ConnectionError(
                 f'{self.flag}直播检测请求状态码错误\n{error}\n{response.text}')
         except anyio.EndOfStream as error:
+            metrics.inc('request_errors_total', platform=self.platform, room=self.id, error=type(error).__name__)
             raise ConnectionError(f'{self.flag}直播检测代理错误\n{error}')
         except httpx.HTTPError as error:
-           logger.error(f'网络异常 重试...')
-           raise ConnectionError(f'{self.flag}直播检测请求错误\n{repr(error)}')
-		
-           
+            metrics.inc('request_errors_total', platform=self.platform, room=self.id, error=type(error).__name__)
+            logger.error(f'网络异常 重试...')
+            raise ConnectionError(f'{self.flag}直播检测请求错误\n{repr(error)}')
+        finally:
+            metrics.observe('poll_seconds', time.monotonic() - start_time, platform=self.platform, room=self.id)
+
+    async def scrape(self, url, done, conditional=False, **kwargs) -> Optional[bytearray]:
+        """流式读取页面，每收到一段数据调用done(已读取内容, 本次新增数据的起始位置)，返回真值时停止下载，
+        返回已读取的内容；conditional为True时携带上次未开播时的ETag和Last-Modified，页面未变化时返回None"""
+        if conditional and self.room.validators:
+            kwargs['headers'] = {**kwargs.get('headers', {}), **self.room.validators}
+        response = await self.request('GET', url, stream=True, **kwargs)
+        content = bytearray()
+        try:
+            if response.status_code == 304:
+                return None
+            async for chunk in response.aiter_bytes():
+                start = len(content)
+                content += chunk
+                if done(content, start):
+                    break
+        except httpx.HTTPError as error:
+            metrics.inc('request_errors_total', platform=self.platform, room=self.id, error=type(error).__name__)
+            raise ConnectionError(f'{self.flag}直播检测请求错误\n{repr(error)}')
+        finally:
+            await response.aclose()
+            metrics.inc('scrape_bytes_total', len(content), platform=self.platform)
+        if conditional:
+            # 开播时由调用方清除，只有未开播的页面未变化才能确定直播状态未变化
+            validators = {'If-None-Match': response.headers.get('ETag'),
+                          'If-Modified-Since': response.headers.get('Last-Modified')}
+            self.room.validators = {key: value for key, value in validators.items() if value} or None
+        return content
 
     def get_client(self):
         client_kwargs = {
             'http2': True,
-            'timeout': self.interval,
-            'limits': httpx.Limits(max_keepalive_connections=100, keepalive_expiry=self.interval * 2),
-            'headers': self.headers,
-            'cookies': self.cookies
+            'verify': self.room.ssl,
+            'limits': httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
         }
         # 检查是否有设置代理
         if self.proxy:
             if 'socks' in self.proxy:
-                client_kwargs['transport'] = AsyncProxyTransport.from_url(self.proxy)
+                client_kwargs['transport'] = AsyncProxyTransport.from_url(
+                    self.proxy, http2=True, verify=self.room.ssl, limits=client_kwargs['limits'])
             else:
-                client_kwargs['proxies'] = self.proxy
+                client_kwargs['proxy'] = self.proxy
         return httpx.AsyncClient(**client_kwargs)
 
+    def reset_client(self, client: httpx.AsyncClient):
+        # 仅当出错的连接池仍在使用时才替换，其他直播间随后会自动使用新的连接池
+        if clients.get(self.client_key) is client:
+            clients.pop(self.client_key)
+            # 延迟关闭旧连接池，避免中断其他直播间正在进行的请求
+            asyncio.get_running_loop().call_later(60, lambda: asyncio.ensure_future(client.aclose()))
+
     def get_cookies(self):
         if self.cookies:
             cookies = SimpleCookie()
@@ -132,12 +1403,20 @@ class LiveRecoder:
         return filename
 
     def get_streamlink(self):
+        # 相同代理、SSL、请求头和cookie配置的直播间共用同一个streamlink会话及其连接池
+        key = json.dumps([self.proxy, self.room.ssl, self.headers, self.cookies], sort_keys=True)
+        with sessions_lock:
+            if key not in sessions:
+                sessions[key] = self.create_streamlink()
+            return sessions[key]
+
+    def create_streamlink(self):
         session = streamlink.session.Streamlink({
             'stream-segment-timeout': 60,
             'hls-segment-queue-threshold': 10
         })
-        ssl = self.ssl
-        logger.info(f'是否验证SSL：{ssl}')
+        ssl = self.room.ssl
+        logger.debug('{}是否验证SSL：{}', self.flag, ssl)
         session.set_option('http-ssl-verify', ssl)
         # 添加streamlink的http相关选项
         if proxy := self.proxy:
@@ -151,69 +1430,266 @@ class LiveRecoder:
             session.set_option('http-cookies', self.cookies)
         return session
 
+    async def resolve(self, func):
+        """在解析线程池中执行阻塞的直播流解析，超时后放弃等待"""
+        future = asyncio.get_running_loop().run_in_executor(resolver, func)
+        return await asyncio.wait_for(future, self.resolve_timeout)
+
+    async def record(self, stream, url, title, format):
+        # 录制线程中重新连接时通过事件循环获取新的直播流
+        self.loop = asyncio.get_running_loop()
+        await record_pool.record(self, stream, url, title, format)
+
+    async def reconnect(self, url, stream, attempt):
+        """返回重新连接使用的直播流，默认首次重试原直播流链接，之后重新解析直播间，平台可按需切换CDN或备用链接"""
+        if attempt == 1:
+            return stream
+        stream_cache.pop(url, None)
+        return (await self.get_streams(url, self.stream_options())).get('best')
+
+    def stream_options(self) -> Optional[Options]:
+        """解析直播流时传给插件的选项，检测和重新连接时使用相同的选项"""
+        return None
+
+    def reopen(self, url, stream, attempt):
+        """按重试次数退避后重新打开直播流，返回(直播流, 直播流读取对象, 预读数据, 已重试次数)，超过重试次数返回None"""
+        while attempt < self.reconnect_attempts and not stopping.wait(self.reconnect_delay * 2 ** attempt):
+            attempt += 1
+            try:
+                new_stream = asyncio.run_coroutine_threadsafe(
+                    self.reconnect(url, stream, attempt), self.loop).result(self.resolve_timeout)
+                if not new_stream:
+                    logger.warning(f'{self.flag}第{attempt}次重新连接未获取到直播流')
+                    continue
+                if isinstance(new_stream, HLSStream):
+                    new_stream.written_sequence = getattr(stream, 'written_sequence', -1)
+                    self.continuous(new_stream)
+                stream_fd, prebuffer = open_stream(new_stream)
+                return new_stream, stream_fd, prebuffer, attempt
+            except Exception as error:
+                logger.warning(f'{self.flag}第{attempt}次重新连接失败\n{repr(error)}')
+        return None
+
+    @staticmethod
+    def continuous(stream):
+        # 插件自定义的HLS直播流（如Twitch过滤广告）保留其原有的读取方式
+        if type(stream) is HLSStream:
+            stream.__reader__ = ContinuousHLSReader
+
+    async def get_streams(self, url, options=None):
+        # 录制中断后短时间内重新录制时复用上次的解析结果，跳过插件解析，插件选项不同的解析结果不复用
+        key = tuple(sorted(options.items())) if options else ()
+        if url in stream_cache and time.monotonic() - stream_cache[url][0] < self.stream_cache_ttl \
+                and stream_cache[url][1] == key:
+            return stream_cache[url][2]
+        streams = await self.resolve(lambda: self.get_streamlink().streams(url, options))
+        if streams:
+            stream_cache[url] = (time.monotonic(), key, streams)
+        return streams
+
     def run_record(self, stream: Union[StreamIO, HTTPStream], url, title, format):
-        # 获取输出文件名
+        # 获取输出文件名，录制期间修改配置的输出目录不影响本次录制
         filename = self.get_filename(title, format)
+        # 配置了多个输出目录且直播间未单独指定输出目录时，由输出目录管理分配
+        output = storage.choose(self.room.bitrate or record_pool.default_bitrate) if storage.volumes and 'output' not in self.room.user else self.output
+        path = Path(f'{output}/{filename}')
         if stream:
-            logger.info(f'{self.flag}开始录制：{filename}')
+            # 短时间内重新开播或程序重启后视为同一场直播，沿用上次的文件名并继续分段编号
+            self.session, path, self.parts = store.open_session(self.room, url, title, path, self.resume_window)
+            path = Path(f'{output}/{path.name}')
+            filename = path.name
+            logger.info(f'{self.flag}{"继续" if self.parts else "开始"}录制：{filename}')
+            self.room.offline_since = None
+            if not self.parts:
+                self.room.live_times = (*self.room.live_times, day_seconds())[-10:]
+            store.save_room(self.room)
             # 调用streamlink录制直播
-            result = self.stream_writer(stream, url, filename)
-            # 录制成功、format配置存在且不等于直播平台默认格式时运行ffmpeg封装
-            if result and self.format and self.format != format:
-                self.run_ffmpeg(filename, format)
+            self.stream_writer(stream, url, path, format)
+            store.close_session(self.session)
             recording.pop(url, None)
+            self.room.offline_since = time.time()
+            store.save_room(self.room)
             logger.info(f'{self.flag}停止录制：{filename}')
         else:
             logger.error(f'{self.flag}无可用直播源：{filename}')
 
-    def stream_writer(self, stream, url, filename):
+    @property
+    def segmented(self):
+        return bool(self.segment_size or self.segment_duration)
+
+    def get_output(self, path: Path, format):
+        if self.segmented:
+            if format not in ('flv', 'ts'):
+                logger.warning(f'{self.flag}{format}格式不支持分段录制，将录制为单个文件：{path.name}')
+
+            def open_part(index):
+                return self.open_file(path.with_name(f'{path.stem}_P{index:03d}{path.suffix}'), index, format)
+
+            def close_part(output):
+                logger.info(f'{self.flag}分段录制完成：{output.filename.name}')
+                self.close_file(output, format)
+
+            output = SegmentedOutput(format, open_part, close_part, self.segment_size, self.segment_duration)
+            output.index = self.parts
+            return output
+        part = self.parts + 1
+        if part > 1:
+            path = path.with_name(f'{path.stem}_P{part:03d}{path.suffix}')
+        return self.open_file(path, part, format)
+
+    def open_file(self, path: Path, part: int, format):
+        output = self.get_part_output(path)
+        # format配置存在且不等于直播平台默认格式时，录制结束后需要运行ffmpeg封装
+        target = None
+        if self.format and self.format != format and not self.remux_live:
+            target = str(path.with_suffix(f'.{self.format}'))
+        store.add_file(self.session, output.filename, part, self.flag, target)
+        return output
+
+    def close_file(self, output, format, remux=True):
+        store.close_file(output.filename, output.written)
+        if not output.written:
+            return
+        if self.format and self.format != format and not self.remux_live:
+            if remux:
+                self.run_ffmpeg(output.filename)
+        else:
+            storage.offload(Path(output.filename))
+
+    def get_part_output(self, path: Path):
+        if self.remux_live and self.format and f'.{self.format}' != path.suffix:
+            # 边录制边封装，mp4使用分片格式，无需录制结束后再次改写整个文件
+            movflags = 'frag_keyframe+empty_moov' if self.format in ('mp4', 'mov') else None
+            return FFmpegOutput(
+                path.with_suffix(f'.{self.format}'),
+                codec='copy',
+                map_metadata='-1',
+                **({'movflags': movflags} if movflags else {})
+            )
+        return BufferedFileOutput(
+            path,
+            self.write_buffer,
+            self.preallocate,
+            self.fsync_interval
+        )
+
+    def write_stream(self, stream_fd, output, prebuffer, filename, chunk_size=65536):
+        """不显示进度条的录制循环，定期输出录制速率"""
+        output.write(prebuffer)
+        report_time = time.monotonic()
+        report_size = output.written
+        while data := stream_fd.read(chunk_size):
+            output.write(data)
+            if (now := time.monotonic()) - report_time >= 60:
+                logger.info(f'{self.flag}录制速率：{(output.written - report_size) / (now - report_time) / 1024 / 1024:.2f}MB/s，'
+                            f'已录制{output.written / 1024 / 1024:.0f}MB：{filename}')
+                report_time, report_size = now, output.written
+
+    def stream_writer(self, stream, url, path: Path, format):
+        filename = path.name
         logger.info(f'{self.flag}获取到直播流链接：{filename}\n{stream.url}')
-        output = FileOutput(Path(f'{self.output}/{filename}'))
+        output = self.get_output(path, format)
+        result = False
         try:
-            stream_fd, prebuffer = open_stream(stream)
-            output.open()
+            self.continuous(stream)
+            opening = file_opener.submit(output.open)
+            try:
+                stream_fd, prebuffer = open_stream(stream)
+            finally:
+                opening.result()
+            if prebuffer[:3] == b'FLV':
+                stream_fd = FlvTagReader(stream_fd)
+                prebuffer = stream_fd.align(prebuffer)
             recording[url] = (stream_fd, output)
-            logger.info(f'{self.flag}正在录制：{filename}')
-            StreamRunner(stream_fd, output, show_progress=True).run(prebuffer)
-            return True
+            latency = time.monotonic() - self.check_time
+            metrics.observe('first_write_seconds', latency, platform=self.platform, room=self.id)
+            logger.info(f'{self.flag}正在录制，开播检测到开始写入耗时{latency:.2f}s：{filename}')
+            start_time = time.monotonic()
+            attempt = 0
+            while True:
+                connect_time = time.monotonic()
+                try:
+                    if self.progress:
+                        StreamRunner(stream_fd, output, show_progress=True).run(prebuffer)
+                    else:
+                        self.write_stream(stream_fd, output, prebuffer, filename)
+                    error = None
+                except Exception as read_error:
+                    if stopping.is_set() or self.room.removed or not self.reconnect_attempts:
+                        raise
+                    error = read_error
+                    logger.warning(f'{self.flag}直播流中断，尝试重新连接：{filename}\n{error}')
+                stream_fd.close()
+                if stopping.is_set() or self.room.removed:
+                    break
+                # 上次连接持续录制一段时间后重新计算重试次数
+                if time.monotonic() - connect_time >= 60:
+                    attempt = 0
+                if not (reopened := self.reopen(url, stream, attempt)):
+                    if error:
+                        raise error
+                    break
+                previous = stream_fd
+                stream, stream_fd, prebuffer, attempt = reopened
+                metrics.inc('reconnects_total', platform=self.platform, room=self.id)
+                logger.info(f'{self.flag}已重新连接直播流，继续写入：{filename}')
+                if isinstance(output, SegmentedOutput):
+                    # 丢弃上次连接未解析完的数据，新连接的数据从完整的标签或TS包处开始
+                    output.buffer.clear()
+                if prebuffer[:3] == b'FLV':
+                    # 新连接的FLV文件头不再重复写入，标签时间戳接续上次连接
+                    stream_fd = FlvTagReader(stream_fd, previous if isinstance(previous, FlvTagReader) else None)
+                    prebuffer = stream_fd.align(prebuffer)
+                recording[url] = (stream_fd, output)
+            self.room.bitrate = output.written * 8 / max(time.monotonic() - start_time, 1)
+            result = True
         except Exception as error:
             if 'timeout' in str(error):
                 logger.warning(f'{self.flag}直播录制超时，请检查主播是否正常开播或网络连接是否正常：{filename}\n{error}')
             elif re.search(f'SSL: CERTIFICATE_VERIFY_FAILED', str(error)):
                 logger.warning(f'{self.flag}SSL错误，将取消SSL验证：{filename}\n{error}')
-                self.ssl = False
+                self.room.ssl = False
             elif re.search(f'(Unable to open URL|No data returned from stream)', str(error)):
                 logger.warning(f'{self.flag}直播流打开错误，请检查主播是否正常开播：{filename}\n{error}')
             else:
                 logger.exception(f'{self.flag}直播录制错误：{filename}\n{error}')
         finally:
             output.close()
+            # 录制成功时封装，分段录制时每个分段结束后已单独封装
+            if not self.segmented:
+                self.close_file(output, format, result)
+        return result
 
-    def run_ffmpeg(self, filename, format):
-        logger.info(f'{self.flag}开始ffmpeg封装：{filename}')
-        new_filename = filename.replace(f'.{format}', f'.{self.format}')
-        ffmpeg.input(f'{self.output}/{filename}').output(
-            f'{self.output}/{new_filename}',
-            codec='copy',
-            map_metadata='-1',
-            movflags='faststart'
-        ).global_args('-hide_banner').run()
-        os.remove(f'{self.output}/{filename}')
+    def run_ffmpeg(self, path: Path):
+        postprocessor.submit(self.flag, str(path), str(path.with_suffix(f'.{self.format}')))
 
 
 class Bilibili(LiveRecoder):
+    batch_limit = 50
+
+    async def get_status_batch(self, ids):
+        response = (await self.request(
+            method='GET',
+            url='https://api.live.bilibili.com/xlive/web-room/v1/index/getRoomBaseInfo',
+            params={'room_ids': ids, 'req_biz': 'web_room_componet'}
+        )).json()
+        return response['data']['by_room_ids'] or {}
+
     async def run(self):
         url = f'https://live.bilibili.com/{self.id}'
         if url not in recording:
-            response = (await self.request(
-                method='GET',
-                url='https://api.live.bilibili.com/room/v1/Room/get_info',
-                params={'room_id': self.id}
-            )).json()
-            if response['data']['live_status'] == 1:
-                title = response['data']['title']
-                stream = self.get_streamlink().streams(url).get('best')  # HTTPStream[flv]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'flv')
+            data = await self.get_status()
+            if not data:
+                # 批量接口仅支持真实房间号，短号等情况回退到单独查询
+                data = (await self.request(
+                    method='GET',
+                    url='https://api.live.bilibili.com/room/v1/Room/get_info',
+                    params={'room_id': self.id}
+                )).json()['data']
+            if data['live_status'] == 1:
+                title = data['title']
+                stream = (await self.get_streams(url)).get('best')  # HTTPStream[flv]
+                await self.record(stream, url, title, 'flv')
 
 
 class Douyu(LiveRecoder):
@@ -225,45 +1701,55 @@ class Douyu(LiveRecoder):
                 url=f'https://open.douyucdn.cn/api/RoomApi/room/{self.id}',
             )).json()
             state = response['data']['room_status']
-            self.mState = state
-            logger.info(
-                f'直播状态[1已开播，2未开播]：{state} 上一次开播时间：{response["data"]["start_time"]}')
+            self.room.mState = state
+            logger.debug('{}直播状态[1已开播，2未开播]：{} 上一次开播时间：{}', self.flag, state, response['data']['start_time'])
             if state == '1':
                 liveUrl = await self.get_live()
                 if liveUrl != '':
                     title = response['data']['room_name']
-                    stream = HTTPStream(
+                    stream = await self.resolve(lambda: HTTPStream(
                         self.get_streamlink(),
                         liveUrl
-                    )  # HTTPStream[flv]
-                    await asyncio.to_thread(self.run_record, stream, url, title, 'flv')
+                    ))  # HTTPStream[flv]
+                    await self.record(stream, url, title, 'flv')
             else:
-                self.ssl = True
+                self.room.ssl = True
+
+    async def prepare(self):
+        await super().prepare()
+        # 预先获取签名脚本并加载到JS引擎中
+        js_enc = await self.get_js()
+        js_cache.call(self.crypto_js_url, js_enc, 'ub98484234', self.id, uuid.uuid4().hex, str(int(time.time())))
 
     async def get_js(self):
-        response = (await self.request(
-            method='POST',
-            url=f'https://www.douyu.com/swf_api/homeH5Enc?rids={self.id}'
-        )).json()
-        js_enc = response['data'][f'room{self.id}']
-        getUrl = self.crypto_js_url
-        crypto_js = (await self.request(
-            method='GET',
-            url= getUrl
-        )).text
-        return jsengine.JSEngine(js_enc + crypto_js)
+        # crypto-js和直播间签名脚本均缓存，过期后才重新获取
+        await js_cache.get(self, self.crypto_js_url, self.js_ttl)
+        if time.time() - self.room.js_enc_time >= self.js_enc_ttl:
+            response = (await self.request(
+                method='POST',
+                url=f'https://www.douyu.com/swf_api/homeH5Enc?rids={self.id}'
+            )).json()
+            self.room.js_enc = response['data'][f'room{self.id}']
+            self.room.js_enc_time = time.time()
+        return self.room.js_enc
+
+    async def reconnect(self, url, stream, attempt):
+        # 依次切换getH5Play返回的其他CDN
+        cdns = getattr(self, 'cdns', []) or ['tct-h5']
+        live_url = await self.get_live(cdns[attempt % len(cdns)])
+        return HTTPStream(self.get_streamlink(), live_url) if live_url else None
 
-    async def get_live(self):
+    async def get_live(self, cdn='tct-h5'):
         did = uuid.uuid4().hex
         tt = str(int(time.time()))
         params = {
-            'cdn': 'tct-h5',
+            'cdn': cdn,
             'did': did,
             'tt': tt,
             'rate': 0
         }
-        js = await self.get_js()
-        query = js.call('ub98484234', self.id, did, tt)
+        js_enc = await self.get_js()
+        query = js_cache.call(self.crypto_js_url, js_enc, 'ub98484234', self.id, did, tt)
         params.update({k: v[0] for k, v in parse_qs(query).items()})
         response = (await self.request(
             method='POST',
@@ -271,23 +1757,32 @@ class Douyu(LiveRecoder):
             params=params
         )).json()
         if response['data'] == '' and response['msg'] != '':
-            logger.info(f'直播状态：{response["error"]} {response["msg"]}')
+            logger.debug('{}直播状态：{} {}', self.flag, response['error'], response['msg'])
             return ''
+        self.cdns = [item['cdn'] for item in response['data'].get('cdnsWithName') or []]
         return f"{response['data']['rtmp_url']}/{response['data']['rtmp_live']}"
 
 
 class Huya(LiveRecoder):
+    live_pattern = re.compile(rb'"isOn":(true|false)')
+    title_pattern = re.compile(rb'"introduction":"(.*?)"')
+
+    def scraped(self, content, start):
+        # 读到直播状态即可停止，开播时还需读到直播标题，已读取的部分不重复查找
+        if not self.live:
+            self.live = self.live_pattern.search(content, max(start - 16, 0))
+        return self.live and (self.live[1] == b'false' or self.title_pattern.search(content))
+
     async def run(self):
         url = f'https://www.huya.com/{self.id}'
         if url not in recording:
-            response = (await self.request(
-                method='GET',
-                url=url
-            )).text
-            if '"isOn":true' in response:
-                title = re.search('"introduction":"(.*?)"', response).group(1)
-                stream = self.get_streamlink().streams(url).get('best')  # HTTPStream[flv]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'flv')
+            self.live = None
+            response = await self.scrape(url, self.scraped, conditional=True)
+            if response and self.live and self.live[1] == b'true':
+                self.room.validators = None
+                title = self.title_pattern.search(response)[1].decode()
+                stream = (await self.get_streams(url)).get('best')  # HTTPStream[flv]
+                await self.record(stream, url, title, 'flv')
 
 
 class Douyin(LiveRecoder):
@@ -295,7 +1790,7 @@ class Douyin(LiveRecoder):
         url = f'https://live.douyin.com/{self.id}'
         if url not in recording:
             if not self.client.cookies:
-                await self.client.get(url='https://live.douyin.com/')  # 获取ttwid
+                await self.request(method='GET', url='https://live.douyin.com/')  # 获取ttwid
             response = (await self.request(
                 method='GET',
                 url='https://live.douyin.com/webcast/room/web/enter/',
@@ -313,20 +1808,70 @@ class Douyin(LiveRecoder):
                 data = data[0]
                 if data['status'] == 2:
                     title = data['title']
-                    live_url = ''
                     stream_data = json.loads(data['stream_url']['live_core_sdk_data']['pull_data']['stream_data'])
-                    for quality_code in ('origin', 'uhd', 'hd', 'sd', 'md', 'ld'):
-                        if quality_data := stream_data['data'].get(quality_code):
-                            live_url = quality_data['main']['flv']
-                            break
-                    stream = HTTPStream(
+                    # 按画质从高到低排列的直播流链接，最高画质用于录制，其余在重新连接时备用
+                    self.live_urls = [
+                        stream_data['data'][quality_code]['main']['flv']
+                        for quality_code in ('origin', 'uhd', 'hd', 'sd', 'md', 'ld')
+                        if stream_data['data'].get(quality_code)
+                    ] or ['']
+                    stream = await self.resolve(lambda: HTTPStream(
                         self.get_streamlink(),
-                        live_url
-                    )  # HTTPStream[flv]
-                    await asyncio.to_thread(self.run_record, stream, url, title, 'flv')
+                        self.live_urls[0]
+                    ))  # HTTPStream[flv]
+                    await self.record(stream, url, title, 'flv')
+
+    async def reconnect(self, url, stream, attempt):
+        # 首次重试原链接，之后依次切换其他画质的链接
+        return HTTPStream(self.get_streamlink(), self.live_urls[(attempt - 1) % len(self.live_urls)])
 
 
 class Youtube(LiveRecoder):
+    # 页面结构变化时使用的通用遍历，预先编译避免每次检测重复解析表达式
+    jsonpath = parse('$..videoWithContextRenderer')
+
+    @classmethod
+    def get_videos(cls, response: dict):
+        """按MWEB频道直播页的已知结构提取视频，结构变化时回退到完整遍历"""
+        videos = []
+        try:
+            for tab in response['contents']['singleColumnBrowseResultsRenderer']['tabs']:
+                content = tab.get('tabRenderer', {}).get('content', {})
+                for item in content.get('richGridRenderer', {}).get('contents', []):
+                    if video := item.get('richItemRenderer', {}).get('content', {}).get('videoWithContextRenderer'):
+                        videos.append(video)
+                for section in content.get('sectionListRenderer', {}).get('contents', []):
+                    for item in section.get('itemSectionRenderer', {}).get('contents', []):
+                        if video := item.get('videoWithContextRenderer'):
+                            videos.append(video)
+        except (KeyError, TypeError, AttributeError):
+            pass
+        return videos or [match.value for match in cls.jsonpath.find(response)]
+
+    @classmethod
+    def is_live(cls, video) -> bool:
+        """视频数据中任意位置存在style为LIVE即为正在直播，优先检查缩略图上的直播标识"""
+        for overlay in video.get('thumbnailOverlays', []):
+            if overlay.get('thumbnailOverlayTimeStatusRenderer', {}).get('style') == 'LIVE':
+                return True
+        stack = [video]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, dict):
+                if value.get('style') == 'LIVE':
+                    return True
+                stack.extend(value.values())
+            elif isinstance(value, list):
+                stack.extend(value)
+        return False
+
+    @classmethod
+    def get_live_videos(cls, content: bytes):
+        # 响应中不存在LIVE标识时无需解析整个JSON
+        if b'"LIVE"' not in content:
+            return []
+        return [video for video in cls.get_videos(json.loads(content)) if cls.is_live(video)]
+
     async def run(self):
         response = (await self.request(
             method='POST',
@@ -347,63 +1892,81 @@ class Youtube(LiveRecoder):
                 'browseId': self.id,
                 'params': 'EgdzdHJlYW1z8gYECgJ6AA%3D%3D'
             }
-        )).json()
-        jsonpath = parse('$..videoWithContextRenderer').find(response)
-        for match in jsonpath:
-            video = match.value
-            if '"style": "LIVE"' in json.dumps(video):
-                url = f"https://www.youtube.com/watch?v={video['videoId']}"
-                title = video['headline']['runs'][0]['text']
-                if url not in recording:
-                    stream = self.get_streamlink().streams(url).get('best')  # HLSStream[mpegts]
-                    # FIXME:多开直播间中断
-                    asyncio.create_task(asyncio.to_thread(self.run_record, stream, url, title, 'ts'))
+        )).content
+        for video in self.get_live_videos(response):
+            url = f"https://www.youtube.com/watch?v={video['videoId']}"
+            title = video['headline']['runs'][0]['text']
+            if url == self.admitted:
+                # 排队后重新检测时直接录制，录制结束前不释放已占用的名额
+                await self.record((await self.get_streams(url)).get('best'), url, title, 'ts')
+            elif url not in recording and not record_pool.busy(url):
+                stream = (await self.get_streams(url)).get('best')  # HLSStream[mpegts]
+                # FIXME:多开直播间中断
+                asyncio.create_task(self.record(stream, url, title, 'ts'))
 
 
 class Twitch(LiveRecoder):
+    # Twitch GQL单次请求最多支持35个操作
+    batch_limit = 35
+
+    async def get_status_batch(self, ids):
+        response = (await self.request(
+            method='POST',
+            url='https://gql.twitch.tv/gql',
+            headers={'Client-Id': 'kimne78kx3ncx6brgo4mv6wki5h1ko'},
+            json=[{
+                'operationName': 'StreamMetadata',
+                'variables': {'channelLogin': channel},
+                'extensions': {
+                    'persistedQuery': {
+                        'version': 1,
+                        'sha256Hash': 'a647c2a13599e5991e175155f798ca7f1ecddde73f7f341f39009c14dbf59962'
+                    }
+                }
+            } for channel in ids]
+        )).json()
+        return {channel: item['data']['user'] for channel, item in zip(ids, response)}
+
     async def run(self):
         url = f'https://www.twitch.tv/{self.id}'
         if url not in recording:
-            response = (await self.request(
-                method='POST',
-                url='https://gql.twitch.tv/gql',
-                headers={'Client-Id': 'kimne78kx3ncx6brgo4mv6wki5h1ko'},
-                json=[{
-                    'operationName': 'StreamMetadata',
-                    'variables': {'channelLogin': self.id},
-                    'extensions': {
-                        'persistedQuery': {
-                            'version': 1,
-                            'sha256Hash': 'a647c2a13599e5991e175155f798ca7f1ecddde73f7f341f39009c14dbf59962'
-                        }
-                    }
-                }]
-            )).json()
-            if response[0]['data']['user']['stream']:
-                title = response[0]['data']['user']['lastBroadcast']['title']
-                options = Options()
-                options.set('disable-ads', True)
-                stream = self.get_streamlink().streams(url, options).get('best')  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+            user = await self.get_status()
+            if user and user['stream']:
+                title = user['lastBroadcast']['title']
+                stream = (await self.get_streams(url, self.stream_options())).get('best')  # HLSStream[mpegts]
+                await self.record(stream, url, title, 'ts')
+
+    def stream_options(self):
+        options = Options()
+        options.set('disable-ads', True)
+        return options
 
 
 class Niconico(LiveRecoder):
+    live_pattern = re.compile(rb'"content_status":"(\w+)"')
+    title_pattern = re.compile(rb'<script type="application/ld\+json">(.*?)</script>')
+
+    def scraped(self, content, start):
+        # 读到直播状态即可停止，直播中还需读到包含标题的ld+json，已读取的部分不重复查找
+        if not self.live:
+            self.live = self.live_pattern.search(content, max(start - 64, 0))
+        return self.live and (self.live[1] != b'ON_AIR' or self.title_pattern.search(content))
+
     async def run(self):
         url = f'https://live.nicovideo.jp/watch/{self.id}'
         if url not in recording:
-            response = (await self.request(
-                method='GET',
-                url=url
-            )).text
-            if '"content_status":"ON_AIR"' in response:
-                title = json.loads(
-                    re.search(r'<script type="application/ld\+json">(.*?)</script>', response).group(1)
-                )['name']
-                stream = self.get_streamlink().streams(url).get('best')  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+            self.live = None
+            response = await self.scrape(url, self.scraped, conditional=True)
+            if response and self.live and self.live[1] == b'ON_AIR':
+                self.room.validators = None
+                title = json.loads(self.title_pattern.search(response)[1])['name']
+                stream = (await self.get_streams(url)).get('best')  # HLSStream[mpegts]
+                await self.record(stream, url, title, 'ts')
 
 
 class Twitcasting(LiveRecoder):
+    title_pattern = re.compile(rb'<meta name="twitter:title" content="(.*?)">')
+
     async def run(self):
         url = f'https://twitcasting.tv/{self.id}'
         if url not in recording:
@@ -416,13 +1979,11 @@ class Twitcasting(LiveRecoder):
                 }
             )).json()
             if response:
-                response = (await self.request(
-                    method='GET',
-                    url=url
-                )).text
-                title = re.search('<meta name="twitter:title" content="(.*?)">', response).group(1)
-                stream = self.get_streamlink().streams(url).get('best')  # Stream[mp4]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'mp4')
+                # 标题位于页面头部，读到后即停止下载
+                response = await self.scrape(url, lambda content, start: self.title_pattern.search(content))
+                title = self.title_pattern.search(response)[1].decode()
+                stream = (await self.get_streams(url)).get('best')  # Stream[mp4]
+                await self.record(stream, url, title, 'mp4')
 
 
 class Afreeca(LiveRecoder):
@@ -436,8 +1997,8 @@ class Afreeca(LiveRecoder):
             )).json()
             if response['CHANNEL']['RESULT'] != 0:
                 title = response['CHANNEL']['TITLE']
-                stream = self.get_streamlink().streams(url).get('best')  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                stream = (await self.get_streams(url)).get('best')  # HLSStream[mpegts]
+                await self.record(stream, url, title, 'ts')
 
 
 class Pandalive(LiveRecoder):
@@ -457,8 +2018,8 @@ class Pandalive(LiveRecoder):
             )).json()
             if response['result']:
                 title = response['media']['title']
-                stream = self.get_streamlink().streams(url).get('best')  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                stream = (await self.get_streams(url)).get('best')  # HLSStream[mpegts]
+                await self.record(stream, url, title, 'ts')
 
 
 class Bigolive(LiveRecoder):
@@ -472,32 +2033,45 @@ class Bigolive(LiveRecoder):
             )).json()
             if response['data']['alive']:
                 title = response['data']['roomTopic']
-                stream = HLSStream(
+                stream = await self.resolve(lambda: HLSStream(
                     session=self.get_streamlink(),
                     url=response['data']['hls_src']
-                )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                ))  # HLSStream[mpegts]
+                await self.record(stream, url, title, 'ts')
+
+    async def reconnect(self, url, stream, attempt):
+        # 直播流链接不变，重新读取播放列表即可
+        return stream
 
 
 class Pixivsketch(LiveRecoder):
+    data_pattern = re.compile(rb'<script id="__NEXT_DATA__".*?>(.*?)</script>')
+
+    def scraped(self, content, start):
+        # __NEXT_DATA__脚本结束后即可停止，之后的页面内容不再下载
+        if self.data_start < 0:
+            self.data_start = content.find(b'<script id="__NEXT_DATA__"', max(start - 32, 0))
+        return self.data_start >= 0 and content.find(b'</script>', max(self.data_start, start - 8)) >= 0
+
     async def run(self):
         url = f'https://sketch.pixiv.net/{self.id}'
         if url not in recording:
-            response = (await self.request(
-                method='GET',
-                url=url
-            )).text
-            next_data = json.loads(re.search(r'<script id="__NEXT_DATA__".*?>(.*?)</script>', response)[1])
+            self.data_start = -1
+            response = await self.scrape(url, self.scraped, conditional=True)
+            if response is None:
+                return
+            next_data = json.loads(self.data_pattern.search(response)[1])
             initial_state = json.loads(next_data['props']['pageProps']['initialState'])
             if lives := initial_state['live']['lives']:
+                self.room.validators = None
                 live = list(lives.values())[0]
                 title = live['name']
-                streams = HLSStream.parse_variant_playlist(
+                streams = await self.resolve(lambda: HLSStream.parse_variant_playlist(
                     session=self.get_streamlink(),
                     url=live['owner']['hls_movie']
-                )
+                ))
                 stream = list(streams.values())[0]  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                await self.record(stream, url, title, 'ts')
 
 
 class Chaturbate(LiveRecoder):
@@ -516,38 +2090,281 @@ class Chaturbate(LiveRecoder):
             )).json()
             if response['room_status'] == 'public':
                 title = self.id
-                streams = HLSStream.parse_variant_playlist(
+                streams = await self.resolve(lambda: HLSStream.parse_variant_playlist(
                     session=self.get_streamlink(),
                     url=response['url']
-                )
+                ))
                 stream = list(streams.values())[2]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                await self.record(stream, url, title, 'ts')
+
+
+class HashRing:
+    """一致性哈希环，成员变化时只有少量直播间需要迁移"""
+
+    def __init__(self, members, replicas: int = 100):
+        self.ring = sorted(
+            (int(hashlib.md5(f'{member}#{index}'.encode()).hexdigest()[:16], 16), member)
+            for member in members for index in range(replicas)
+        )
+        self.hashes = [item[0] for item in self.ring]
+
+    def get(self, key: str):
+        if self.ring:
+            index = bisect.bisect(self.hashes, int(hashlib.md5(key.encode()).hexdigest()[:16], 16))
+            return self.ring[index % len(self.ring)][1]
+
 
+class Cluster:
+    """多进程/多主机分片，按一致性哈希将直播间分配给各工作进程，
+    配置lease_db时通过共享存储上的SQLite记录成员心跳和直播间租约，确保每个直播间只由一个工作进程录制"""
 
-async def run():
+    def __init__(self, name: str, members, lease_db: str = None, ttl: float = 30):
+        self.name = name
+        self.members = members
+        self.ttl = ttl
+        self.db = None
+        if lease_db:
+            self.db = sqlite3.connect(lease_db, timeout=ttl, isolation_level=None, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS members (name TEXT PRIMARY KEY, expires REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS leases (room TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def assign(self, rooms, busy):
+        """返回本进程负责的直播间，busy为正在检测或录制的直播间，其租约在结束前会一直续期"""
+        if not self.db:
+            ring = HashRing(self.members)
+            return {room for room in rooms if ring.get(room) == self.name}
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('INSERT OR REPLACE INTO members VALUES (?, ?)', (self.name, now + self.ttl))
+            self.db.execute('DELETE FROM members WHERE expires < ?', (now,))
+            ring = HashRing([row[0] for row in self.db.execute('SELECT name FROM members')])
+            wanted = {room for room in rooms if ring.get(room) == self.name}
+            self.db.executemany(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(room) DO UPDATE SET '
+                'owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                [(room, self.name, now + self.ttl, now) for room in wanted | busy]
+            )
+            held = {row[0] for row in self.db.execute('SELECT room FROM leases WHERE owner = ?', (self.name,))}
+            self.db.executemany('DELETE FROM leases WHERE room = ? AND owner = ?',
+                                [(room, self.name) for room in held - wanted - busy])
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return wanted & held
+
+    def leave(self):
+        if self.db:
+            self.db.execute('DELETE FROM members WHERE name = ?', (self.name,))
+            self.db.execute('DELETE FROM leases WHERE owner = ?', (self.name,))
+
+
+class Manager:
+    """管理所有直播间：按配置增删直播间、监听配置文件变化，以及分片模式下同步直播间归属"""
+
+    def __init__(self, config: dict, scheduler: Scheduler, cluster: Cluster = None):
+        self.config = config
+        self.scheduler = scheduler
+        self.cluster = cluster
+        self.rooms: Dict[Tuple[str, str], Room] = {}
+        # 分片模式下本进程负责的直播间，在首次同步前为空
+        self.owned = set()
+
+    def reconcile(self, config: dict, reload=False):
+        """按配置中的直播间列表增删直播间，并将新配置应用到已有的直播间"""
+        users = {(item['platform'], item['id']): item for item in config['user']}
+        for platform, _ in users:
+            if not isinstance(globals().get(platform), type) or not issubclass(globals()[platform], LiveRecoder):
+                raise ValueError(f'不支持的直播平台：{platform}')
+        self.config = config
+        if self.cluster:
+            # 与sync中的直播间标识一致，id可能为数字
+            users = {key: item for key, item in users.items() if f'{key[0]}/{key[1]}' in self.owned}
+        for key in set(self.rooms) - set(users):
+            room = self.rooms.pop(key)
+            self.scheduler.remove(room)
+            logger.info(f'{room.flag}已从配置中移除，正在进行的录制结束后停止检测')
+        for key, item in users.items():
+            if key in self.rooms:
+                self.rooms[key].configure(config, item)
+            else:
+                room = self.rooms[key] = Room(config, item)
+                store.load_room(room)
+                # 首次检测时间随机分散在一个检测间隔内，避免所有直播间同时请求
+                self.scheduler.add(room, random.uniform(0, room.interval))
+                if reload:
+                    logger.info(f'{room.flag}已添加到配置，开始检测')
+
+    async def watch(self, path: Path, interval):
+        """定期检查配置文件的修改时间和内容，变化时重新加载"""
+        mtime = path.stat().st_mtime
+        digest = hashlib.sha1(path.read_bytes()).hexdigest()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if path.stat().st_mtime == mtime:
+                    continue
+                mtime = path.stat().st_mtime
+                content = path.read_bytes()
+                if hashlib.sha1(content).hexdigest() == digest:
+                    continue
+                self.reconcile(json.loads(content), reload=True)
+                digest = hashlib.sha1(content).hexdigest()
+                logger.info('配置文件已重新加载')
+            except Exception as error:
+                logger.error(f'配置文件重新加载失败，继续使用原配置\n{repr(error)}')
+
+    async def sync(self):
+        """定期续期心跳和租约，成员变化时迁移直播间"""
+        while True:
+            try:
+                rooms = {f'{item["platform"]}/{item["id"]}' for item in self.config['user']}
+                busy = {f'{room.platform}/{room.id}' for room in self.scheduler.running}
+                self.owned = await asyncio.to_thread(self.cluster.assign, rooms, busy)
+                self.reconcile(self.config, reload=True)
+            except Exception as error:
+                logger.error(f'分片同步错误\n{repr(error)}')
+            await asyncio.sleep(self.cluster.ttl / 3)
+
+
+async def run(worker: int = 0):
+    global resolver, record_pool, store, postprocessor, storage
     with open('config.json', 'r', encoding='utf-8') as f:
         config = json.load(f)
+    cluster = None
+    if (workers := config.get('workers', 1)) > 1 or config.get('lease_db'):
+        host = socket.gethostname()
+        # 未配置共享的租约文件时，同一主机的工作进程使用本地租约文件，进程退出后其直播间可转移到其他进程
+        cluster = Cluster(f'{host}-{worker}', [f'{host}-{index}' for index in range(workers)],
+                          config.get('lease_db', 'leases.db'), config.get('lease_ttl', 30))
+        # 各工作进程使用独立的指标端口
+        if config.get('metrics_port'):
+            config['metrics_port'] += worker
+    resolver = ThreadPoolExecutor(max_workers=config.get('resolve_workers', 8), thread_name_prefix='resolver')
+    record_pool = RecordPool(config)
+    store = Store(config.get('state_db', 'state.db'), cluster.name if cluster else '')
+    if count := store.recover():
+        logger.warning(f'上次运行异常退出，已补全{count}个未关闭的录制文件记录')
+    storage = Storage(config)
+    postprocessor = PostProcessor(config)
+    postprocessor.resume()
+    monitor = asyncio.create_task(loop_monitor.run())
+    disk_monitor = asyncio.create_task(storage.run())
     try:
-        tasks = []
-        for item in config['user']:
-            platform_class = globals()[item['platform']]
-            coro = platform_class(config, item).start()
-            tasks.append(asyncio.create_task(coro))
-        await asyncio.wait(tasks)
+        scheduler = Scheduler(config)
+        metrics.scheduler = scheduler
+        if port := config.get('metrics_port'):
+            server = await metrics.serve(config.get('metrics_host', '127.0.0.1'), port)
+        manager = Manager(config, scheduler, cluster)
+        manager.reconcile(config)
+        watcher = asyncio.create_task(manager.watch(Path('config.json'), config.get('reload_interval', 5)))
+        if cluster:
+            syncer = asyncio.create_task(manager.sync())
+        await scheduler.run()
     except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
         logger.warning('用户中断录制，正在关闭直播流')
+        stopping.set()
         for stream_fd, output in recording.copy().values():
             stream_fd.close()
             output.close()
+        if cluster:
+            cluster.leave()
 
 
-if __name__ == '__main__':
+class RepeatLimiter:
+    """同一位置输出的相同日志在interval秒内只记录一次，之后再次出现时注明期间省略的次数，
+    避免直播间每次检测都出错时重复输出相同的日志"""
+
+    def __init__(self, interval: float = 0):
+        self.interval = interval
+        self.last: Dict[Tuple[str, int, str], list] = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        # 作为loguru的patcher每条日志只调用一次，标记结果由各输出的filter判断
+        if not self.interval:
+            return
+        key = (record['name'], record['line'], record['message'])
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(key)
+            if last and now - last[0] < self.interval:
+                last[1] += 1
+                record['extra']['repeated'] = True
+                return
+            if last and last[1]:
+                record['message'] += f'（此前{now - last[0]:.0f}s内重复{last[1]}次已省略）'
+            self.last[key] = [now, 0]
+            if len(self.last) > 10000:
+                self.last = {key: value for key, value in self.last.items() if now - value[0] < self.interval}
+
+
+repeat_limiter = RepeatLimiter()
+
+
+def log_filter(record):
+    return not record['extra'].get('repeated')
+
+
+def setup_logger(config: dict, suffix=''):
+    # 日志经队列由后台线程写入，文件写入不阻塞事件循环和录制线程
+    level = config.get('log_level', 'INFO')
+    repeat_limiter.interval = config.get('log_repeat_interval', 60)
+    logger.remove()
+    logger.configure(extra={'room': '', 'platform': ''}, patcher=repeat_limiter)
+    logger.add(sys.stderr, level=level, filter=log_filter, enqueue=True)
     logger.add(
-        sink='logs/log_{time:YYYY-MM-DD}.log',
+        sink=f'logs/log_{{time:YYYY-MM-DD}}{suffix}.log',
         rotation='00:00',
-        retention='3 days',
-        level='INFO',
+        retention=config.get('log_retention', '3 days'),
+        level=level,
         encoding='utf-8',
+        filter=log_filter,
+        enqueue=True,
+        # 输出JSON格式时每行一条记录，extra中包含直播间id和平台，便于日志系统检索
+        serialize=config.get('log_json', False),
         format='[{time:YYYY-MM-DD HH:mm:ss}][{level}][{name}][{function}:{line}]{message}'
     )
-    asyncio.run(run())
+
+
+def work(worker: int):
+    # 各工作进程写入独立的日志文件，避免多进程同时轮转同一文件
+    with open('config.json', 'r', encoding='utf-8') as f:
+        setup_logger(json.load(f), f'_worker{worker}')
+    try:
+        asyncio.run(run(worker))
+    except KeyboardInterrupt:
+        pass
+
+
+def supervise(workers: int):
+    """启动多个工作进程分片录制，工作进程退出后自动重启"""
+    processes: Dict[int, multiprocessing.Process] = {}
+    try:
+        while True:
+            for index in range(workers):
+                process = processes.get(index)
+                if process and process.is_alive():
+                    continue
+                if process:
+                    logger.warning(f'工作进程{index}已退出（退出码：{process.exitcode}），正在重新启动')
+                processes[index] = multiprocessing.Process(target=work, args=(index,), name=f'worker-{index}')
+                processes[index].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        logger.warning('用户中断录制，正在等待工作进程退出')
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    setup_logger(config)
+    if (workers := config.get('workers', 1)) > 1:
+        supervise(workers)
+    else:
+        asyncio.run(run())